@@ -0,0 +1,132 @@
+"""
+This module runs the classification over a whole archive of scenes.
+Here you will find functions that find the scene directories of each mission,
+skip the scenes that did not change since their last run and store the
+per-scene class pixel counts and areas in a SQLite results file.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from osgeo import gdal
+import data_utils
+import image_utils
+import classify_utils
+
+
+MODEL_VERSION = 1
+RESULTS_FILE = "results.sqlite"
+OUTPUT_DIR = "Classified"
+
+MISSIONS = {
+    "Sentinel-2": "sentinel2",
+    "Landsat-8": "landsat8",
+    "Landsat-7": "landsat7"
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    scene TEXT PRIMARY KEY,
+    mission TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    output TEXT NOT NULL,
+    processed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS class_counts (
+    scene TEXT NOT NULL,
+    class TEXT NOT NULL,
+    pixels INTEGER NOT NULL,
+    area_km2 REAL NOT NULL,
+    PRIMARY KEY (scene, class)
+);
+"""
+
+
+def is_band_file(name):
+    return name.split(".")[0].isdigit()
+
+
+def find_scenes(archive):
+    scenes = []
+    for mission_dir, mission in MISSIONS.items():
+        for root, dirs, files in os.walk(os.path.join(archive, mission_dir)):
+            dirs.sort()
+            if any(is_band_file(x) for x in files):
+                scenes.append((root, mission))
+
+    return scenes
+
+
+def model_key(hcrf_file=data_utils.HCRF_FILE, backend=classify_utils.DEFAULT_BACKEND):
+    settings = [MODEL_VERSION, classify_utils.SCALE_FACTORS, image_utils.KMAX]
+    if backend != classify_utils.DEFAULT_BACKEND:
+        # Scenes classified with the default backend keep the fingerprints they were stored with
+        settings += [backend, classify_utils.NEIGHBOURS]
+    return data_utils.training_key(hcrf_file) + json.dumps(settings, sort_keys=True)
+
+
+def scene_fingerprint(scene_dir, model):
+    digest = hashlib.sha256(model.encode())
+    for band, image_path, size, mtime in image_utils.band_stats(scene_dir):
+        digest.update("{}:{}:{}".format(band, size, mtime).encode())
+
+    return digest.hexdigest()
+
+
+def pixel_area_km2(scene_dir):
+    image_path = image_utils.band_paths(scene_dir)[0][1]
+    ulx, xres, xskew, uly, yskew, yres = gdal.Open(image_path, gdal.GA_ReadOnly).GetGeoTransform()
+    return abs(xres*yres)/1e6
+
+
+def open_results(database=RESULTS_FILE):
+    connection = sqlite3.connect(database)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def store_scene(connection, scene, mission, fingerprint, output, nr_pixels, pixel_area):
+    with connection:
+        connection.execute("DELETE FROM class_counts WHERE scene = ?", (scene,))
+        connection.executemany("INSERT INTO class_counts VALUES (?, ?, ?, ?)",
+                               [(scene, classify_utils.CLASSES[label - 1], count, count*pixel_area)
+                                for label, count in nr_pixels.items()])
+        connection.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?)",
+                           (scene, mission, fingerprint, output, time.time()))
+
+
+def run_batch(archive, database=RESULTS_FILE, output_dir=None, hcrf_file=data_utils.HCRF_FILE, workers=None, force=False,
+              backend=classify_utils.DEFAULT_BACKEND):
+    if output_dir is None:
+        output_dir = os.path.join(archive, OUTPUT_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+
+    data_utils.load_centroids(file=hcrf_file)
+    model = model_key(hcrf_file, backend=backend)
+    connection = open_results(database)
+    done = dict(connection.execute("SELECT scene, fingerprint FROM scenes"))
+
+    pending = {}
+    for scene_dir, mission in find_scenes(archive):
+        scene = os.path.relpath(scene_dir, archive)
+        fingerprint = scene_fingerprint(scene_dir, model)
+        if not force and done.get(scene) == fingerprint:
+            continue
+        output = os.path.join(output_dir, scene.replace(os.sep, "_") + ".tif")
+        pending.setdefault(mission, []).append((scene_dir, scene, fingerprint, output))
+
+    for mission, scenes in pending.items():
+        image_utils.log("Classifying {} {} scenes".format(len(scenes), mission))
+        jobs = [(scene_dir, output) for scene_dir, scene, fingerprint, output in scenes]
+        results = classify_utils.iter_scenes(jobs, mission=mission, workers=workers, backend=backend,
+                                             hcrf_file=hcrf_file)
+        for (scene_dir, scene, fingerprint, output), (source_dir, nr_pixels) in zip(scenes, results):
+            if nr_pixels is None:
+                image_utils.log("ERROR: Could not classify {}".format(scene))
+                continue
+            store_scene(connection, scene, mission, fingerprint, output, nr_pixels, pixel_area_km2(scene_dir))
+
+    connection.close()
+    return sum(len(x) for x in pending.values())
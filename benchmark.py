@@ -0,0 +1,280 @@
+"""
+This module benchmarks the classification pipeline.
+It generates synthetic multi-band rasters shaped like the Sentinel-2,
+Landsat-8 and Landsat-7 layouts (plus a synthetic training data set) and
+also runs on the sample scenes of the repository. Every stage is timed
+separately and the throughput and peak memory are saved as JSON, so results
+can be compared between versions. It runs offline on a CPU-only machine.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy
+from osgeo import gdal, osr
+import data_utils
+import image_utils
+import classify_utils
+import batch_utils
+import ingest_utils
+import profile_utils
+import main
+
+
+SIZES = [512, 1024, 2048]
+STARTUP_REPEATS = 5
+# Modules timed from a fresh interpreter, and the heavy dependencies they should not pull in
+STARTUP_MODULES = ["data_utils", "classify_utils", "main"]
+HEAVY_MODULES = ["pandas", "matplotlib", "PIL", "cv2"]
+MISSIONS = ["sentinel2", "landsat8", "landsat7"]
+WAVELENGTHS = 2151
+SAMPLE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Upper left corner of the Corbassiere crop, in UTM 32N
+ORIGIN = (364090.59, 5096444.81)
+PIXEL_SIZE = 10
+
+
+def measure(stage, pixels, func, *args, **kwargs):
+    # Tracing hooks every allocation, so the timed call runs untraced and a second, traced call of the same
+    # stage measures its peak memory. Stages must therefore give the same work when they are run twice.
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {
+        "stage": stage,
+        "seconds": seconds,
+        "megapixels": pixels/1e6,
+        "megapixels_per_second": pixels/1e6/seconds if pixels and seconds > 0 else None,
+        "peak_traced_mb": peak/2**20
+    }
+
+
+def synthetic_training_data(path, seed=0):
+    rng = numpy.random.default_rng(seed)
+    sites = sorted({x for names in data_utils.SITES.values() for x in names})
+    wavelengths = numpy.arange(data_utils.FIRST_WAVELENGTH, data_utils.FIRST_WAVELENGTH + WAVELENGTHS)
+    with open(path, "w") as f:
+        f.write(",".join(["wavelength"] + sites) + "\n")
+        for wavelength, row in zip(wavelengths, rng.uniform(0.05, 1.0, [WAVELENGTHS, len(sites)])):
+            f.write(",".join([str(wavelength)] + ["{:.6f}".format(x) for x in row]) + "\n")
+
+    return path
+
+
+def synthetic_scene(scene_dir, mission, size, nodata_fraction=0.2, seed=0):
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(scene_dir, exist_ok=True)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32632)
+    driver = gdal.GetDriverByName("GTiff")
+
+    # The same rows are left empty in every band, like the area outside a cutline
+    empty = rng.random(size) < nodata_fraction
+    for band in data_utils.MISSION_BANDS[mission].keys():
+        data = rng.integers(1, 256*image_utils.mission_kmax(mission), [size, size], dtype=numpy.uint16)
+        data[empty] = 0
+        dst = driver.Create(os.path.join(scene_dir, "{}.TIF".format(band)), size, size, 1, gdal.GDT_UInt16)
+        dst.SetGeoTransform((ORIGIN[0], PIXEL_SIZE, 0, ORIGIN[1], 0, -PIXEL_SIZE))
+        dst.SetProjection(srs.ExportToWkt())
+        dst.GetRasterBand(1).WriteArray(data)
+        dst = None
+
+    return scene_dir
+
+
+def run_stages(scene_dir, mission, output, name):
+    paths = image_utils.band_paths(scene_dir)
+    xsize, ysize = image_utils.georeference(gdal.Open(paths[0][1], gdal.GA_ReadOnly))["size"]
+    pixels = xsize*ysize
+    results = []
+
+    IMAGES, result = measure("create_raster", pixels, image_utils.create_raster, scene_dir, mission=mission)
+    results.append(result)
+    labels, result = measure("classification", pixels, classify_utils.classify_raster, IMAGES, mission=mission)
+    results.append(result)
+
+    # Every precision is checked against an exact float64 evaluation; differing labels must all be ties
+    bands = classify_utils.raster_bands(IMAGES)
+    stack = classify_utils.stack_bands(IMAGES, bands)
+    centroids = classify_utils.mission_centroids(bands, mission=mission)
+    for precision in classify_utils.PRECISIONS:
+        result = measure("minimum_distance_" + precision, pixels, classify_utils.minimum_distance, stack, centroids,
+                         precision=precision)[1]
+        result["mismatches"], result["ties"] = classify_utils.precision_mismatches(stack, centroids, precision=precision)
+        results.append(result)
+    result = measure("classification_nearest_reference", pixels, classify_utils.classify_raster, IMAGES, mission=mission,
+                     backend="nearest_reference")[1]
+    results.append(result)
+    del stack
+
+    MAP_DATA = classify_utils.label_colors(labels)
+    result = measure("output", pixels, main.write_classification, labels, MAP_DATA, IMAGES["georeference"],
+                     output=output)[1]
+    results.append(result)
+    result = measure("classify_tiled", pixels, classify_utils.classify_tiled, scene_dir, output + "_tiled.tif",
+                     mission=mission)[1]
+    results.append(result)
+    # The ingested copy goes next to the outputs, so the sample scenes of the repository stay untouched
+    ingested = output + "_ingest"
+    result = measure("ingest_scene", pixels, ingest_utils.ingest_scene, scene_dir, ingested, force=True)[1]
+    results.append(result)
+    result = measure("classify_ingested", pixels, ingest_utils.classify_ingested, scene_dir, mission=mission,
+                     scene_dir=ingested)[1]
+    results.append(result)
+    result = measure("classify_preview", pixels // 16, ingest_utils.classify_ingested, scene_dir, mission=mission,
+                     factor=4, scene_dir=ingested)[1]
+    results.append(result)
+
+    for result in results:
+        result.update(scene=name, mission=mission, bands=len(bands))
+    return results
+
+
+def startup_time(module, repeats=STARTUP_REPEATS):
+    # Best of a few cold starts, measured around the import inside a fresh interpreter
+    code = ("import sys, time, json; start = time.perf_counter(); import {}; "
+            "print(json.dumps([time.perf_counter() - start, sorted(x for x in {} if x in sys.modules)]))")
+    code = code.format(module, json.dumps(HEAVY_MODULES))
+    runs = []
+    for n in range(repeats):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=SAMPLE_DIR)
+        runs.append(json.loads(output))
+
+    return {
+        "stage": "startup_" + module,
+        "seconds": min(x[0] for x in runs),
+        "megapixels": 0,
+        "megapixels_per_second": None,
+        "peak_traced_mb": 0,
+        "heavy_modules": runs[0][1]
+    }
+
+
+def run_benchmarks(sizes=SIZES, missions=MISSIONS, samples=True):
+    results = [startup_time(x) for x in STARTUP_MODULES]
+    workdir = tempfile.mkdtemp(prefix="corbassiere_benchmark_")
+    try:
+        hcrf_file = synthetic_training_data(os.path.join(workdir, "TrainingData.csv"))
+        result = measure("create_dataset", 0, data_utils.create_dataset, file=hcrf_file)[1]
+        results.append(result)
+        result = measure("load_centroids", 0, data_utils.load_centroids, file=hcrf_file, rebuild=True)[1]
+        results.append(result)
+        result = measure("load_centroids_cached", 0, data_utils.load_centroids, file=hcrf_file)[1]
+        results.append(result)
+
+        for mission in missions:
+            for size in sizes:
+                name = "synthetic_{}_{}".format(mission, size)
+                scene_dir = synthetic_scene(os.path.join(workdir, name), mission, size)
+                results += run_stages(scene_dir, mission, os.path.join(workdir, name), name)
+                shutil.rmtree(scene_dir)
+
+        if samples:
+            for scene_dir, mission in batch_utils.find_scenes(SAMPLE_DIR):
+                name = os.path.relpath(scene_dir, SAMPLE_DIR)
+                results += run_stages(scene_dir, mission, os.path.join(workdir, name.replace(os.sep, "_")), name)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def precision_failures(results):
+    # Every label that differs from the exact float64 evaluation must be a documented tie
+    return [x for x in results if x.get("mismatches") != x.get("ties")]
+
+
+def check_precisions(sample_dir=SAMPLE_DIR):
+    # Only the distance kernels, on the sample scenes of the repository
+    results = []
+    workdir = tempfile.mkdtemp(prefix="corbassiere_precision_")
+    try:
+        data_utils.create_dataset(file=synthetic_training_data(os.path.join(workdir, "TrainingData.csv")))
+        for scene_dir, mission in batch_utils.find_scenes(sample_dir):
+            IMAGES = image_utils.create_raster(scene_dir, mission=mission)
+            bands = classify_utils.raster_bands(IMAGES)
+            stack = classify_utils.stack_bands(IMAGES, bands)
+            centroids = classify_utils.mission_centroids(bands, mission=mission)
+            for precision in classify_utils.PRECISIONS:
+                mismatches, ties = classify_utils.precision_mismatches(stack, centroids, precision=precision)
+                results.append({"scene": os.path.relpath(scene_dir, sample_dir),
+                                "stage": "minimum_distance_" + precision, "mismatches": mismatches, "ties": ties})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def report_failures(failures):
+    for result in failures:
+        print("ERROR: {} {}: {} labels differ from float64, only {} of them are ties".format(
+            result.get("scene", "-"), result["stage"], result["mismatches"], result["ties"]))
+    return 1 if failures else 0
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SAMPLE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output):
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "gdal": gdal.__version__,
+        "cpu_count": os.cpu_count(),
+        # Peak of the whole run; the peak of each stage is its peak_traced_mb
+        "max_rss_mb": profile_utils.max_rss_mb(),
+        "results": results
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def print_results(results):
+    print("{:<40} {:<22} {:>10} {:>10} {:>12}".format("scene", "stage", "seconds", "MP/s", "peak MB"))
+    for result in results:
+        throughput = result["megapixels_per_second"]
+        print("{:<40} {:<22} {:>10.3f} {:>10} {:>12.1f}".format(
+            result.get("scene", "-"), result["stage"], result["seconds"],
+            "-" if throughput is None else "{:.2f}".format(throughput), result["peak_traced_mb"]))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the classification pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="edge length of the synthetic rasters")
+    parser.add_argument("--missions", nargs="+", default=MISSIONS, choices=MISSIONS)
+    parser.add_argument("--no-samples", action="store_true", help="skip the sample scenes of the repository")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--check-precisions", action="store_true",
+                        help="only check the distance kernels against float64 on the sample scenes")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.check_precisions:
+        sys.exit(report_failures(precision_failures(check_precisions())))
+    results = run_benchmarks(sizes=args.sizes, missions=args.missions, samples=not args.no_samples)
+    print_results(results)
+    save_results(results, args.output)
+    sys.exit(report_failures(precision_failures(results)))
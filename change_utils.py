@@ -0,0 +1,122 @@
+"""
+This module contains the change analysis of a series of classified scenes.
+Here you will find functions that compare label rasters written by the
+classifier on the same grid, count the class transitions between scenes and
+write a per-pixel change map. The rasters are read block by block, so the
+memory use does not grow with the number of scenes.
+"""
+
+import os
+import csv
+import numpy
+from osgeo import gdal
+import image_utils
+import classify_utils
+import profile_utils
+
+
+# Labels 0 (no data) to 5; a transition a -> b is encoded as a*NR_LABELS + b, which fits in one byte
+NR_LABELS = len(classify_utils.CLASSES) + 1
+LABEL_NAMES = ["NODATA"] + classify_utils.CLASSES
+CHANGE_FILE = "Changes.tif"
+TRANSITIONS_FILE = "Transitions.csv"
+
+
+def encode_transitions(before, after):
+    return before.astype(numpy.uint8)*NR_LABELS + after
+
+
+def decode_transitions(codes):
+    return numpy.divmod(codes, NR_LABELS)
+
+
+def transition_matrix(before, after):
+    # Rows are the labels of the earlier scene, columns the labels of the later one
+    counts = numpy.bincount(encode_transitions(before, after).ravel(), minlength=NR_LABELS**2)
+    return counts.reshape(NR_LABELS, NR_LABELS)
+
+
+def open_label_rasters(label_paths):
+    datasets = []
+    for path in label_paths:
+        src = gdal.Open(path, gdal.GA_ReadOnly)
+        if src is None:
+            image_utils.log("ERROR: Could not open {}".format(path))
+            return None
+        datasets.append(src)
+
+    grid = image_utils.georeference(datasets[0])
+    for path, src in zip(label_paths[1:], datasets[1:]):
+        if image_utils.georeference(src) != grid:
+            image_utils.log("ERROR: {} is not on the grid of {}".format(path, label_paths[0]))
+            return None
+
+    return datasets
+
+
+def create_change_raster(output, georef, names):
+    # One band per pair of consecutive scenes, holding the encoded transition of every pixel
+    driver = gdal.GetDriverByName("GTiff")
+    dst = driver.Create(output, georef["size"][0], georef["size"][1], len(names), gdal.GDT_Byte,
+                        options=["TILED=YES", "COMPRESS=DEFLATE", "INTERLEAVE=BAND"])
+    dst.SetGeoTransform(georef["geotransform"])
+    dst.SetProjection(georef["projection"])
+    for n, name in enumerate(names):
+        dst_band = dst.GetRasterBand(n + 1)
+        dst_band.SetNoDataValue(0)
+        dst_band.SetDescription(name)
+    return dst
+
+
+def scene_names(label_paths):
+    return [os.path.splitext(os.path.basename(x))[0] for x in label_paths]
+
+
+def write_transitions(matrices, table=TRANSITIONS_FILE):
+    with open(table, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["before", "after", "from", "to", "pixels"])
+        for (before, after), matrix in matrices.items():
+            for a, b in zip(*numpy.nonzero(matrix)):
+                writer.writerow([before, after, LABEL_NAMES[a], LABEL_NAMES[b], int(matrix[a, b])])
+
+
+def detect_changes(label_paths, output=CHANGE_FILE, table=TRANSITIONS_FILE, block_size=image_utils.BLOCK_SIZE):
+    if len(label_paths) < 2:
+        image_utils.log("ERROR: At least two label rasters are needed")
+        return None
+    datasets = open_label_rasters(label_paths)
+    if datasets is None:
+        return None
+
+    names = scene_names(label_paths)
+    pairs = list(zip(names[:-1], names[1:]))
+    # With more than two scenes, a first to last scene matrix sums up the whole series
+    overall = (names[0], names[-1]) if len(pairs) > 1 else None
+    matrices = {x: numpy.zeros([NR_LABELS, NR_LABELS], dtype=numpy.int64) for x in pairs + [overall] if x}
+
+    georef = image_utils.georeference(datasets[0])
+    dst = None
+    if output is not None:
+        dst = create_change_raster(output, georef, ["{} -> {}".format(*x) for x in pairs])
+
+    xsize, ysize = georef["size"]
+    with profile_utils.stage("detect_changes", scenes=len(datasets), pixels=xsize*ysize):
+        for xoff, yoff, width, height in image_utils.iter_windows(xsize, ysize, block_size):
+            first = before = datasets[0].GetRasterBand(1).ReadAsArray(xoff, yoff, width, height)
+            for n, (pair, src) in enumerate(zip(pairs, datasets[1:])):
+                after = src.GetRasterBand(1).ReadAsArray(xoff, yoff, width, height)
+                codes = encode_transitions(before, after)
+                matrices[pair] += numpy.bincount(codes.ravel(), minlength=NR_LABELS**2).reshape(NR_LABELS, NR_LABELS)
+                if dst is not None:
+                    dst.GetRasterBand(n + 1).WriteArray(codes, xoff, yoff)
+                before = after
+            if overall:
+                matrices[overall] += transition_matrix(first, before)
+
+    if dst is not None:
+        dst.FlushCache()
+        dst = None
+    if table is not None:
+        write_transitions(matrices, table)
+    return matrices
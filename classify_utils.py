@@ -0,0 +1,359 @@
+"""
+This module contains the classification core used by main.py.
+Here you will find functions that stack the band images into a single
+multidimensional array, compute the class centroids for each mission and
+assign every pixel to the closest centroid in one vectorized pass, or to the
+class of its nearest training spectra with the nearest_reference backend.
+"""
+
+import os
+import glob
+import numpy
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import data_utils
+import image_utils
+import profile_utils
+
+
+CLASSES = ["CI", "SN", "LA", "HA", "CC"]
+NODATA_LABEL = 0
+
+PRECISIONS = ["float32", "float64", "uint16"]
+DEFAULT_PRECISION = "float32"
+# Normalized reflectances stay below 4 (65535/(256*70) for Sentinel-2), so 1/16384 steps fit in uint16
+QUANT_SCALE = 16384
+CHUNK_PIXELS = 1 << 16
+
+SCALE_FACTORS = {
+    "landsat8": 1,
+    "landsat7": 1.2,
+    "sentinel2": 0.5
+}
+
+# Number of reference spectra voting for the class of a pixel in the nearest_reference backend
+NEIGHBOURS = 5
+
+# A backend builds a model for the bands of a scene from its mission library, and labels (N, B) pixels with it
+Backend = namedtuple("Backend", ["library", "model", "classify"])
+Classifier = namedtuple("Classifier", ["backend", "model"])
+
+# State handed to each pool worker once by its initializer
+_WORKER = {}
+
+
+def loaded_library(store, mission, hcrf_file=data_utils.HCRF_FILE):
+    # Entry points can be called on their own: the centroids are loaded (or read from their cache) on first use
+    if not store:
+        data_utils.load_centroids(file=hcrf_file)
+    return store.get(mission) or store["sentinel2"]
+
+
+def mission_library(mission="sentinel2", k=None, hcrf_file=data_utils.HCRF_FILE):
+    library = loaded_library(data_utils.LIBRARY, mission, hcrf_file=hcrf_file)
+    library = data_utils.library_subset(library, classes=CLASSES)
+    if k is None:
+        k = SCALE_FACTORS.get(mission, SCALE_FACTORS["sentinel2"])
+    return library._replace(values=k*library.values)
+
+
+def select_centroids(library, bands):
+    return data_utils.library_subset(library, bands=bands).values
+
+
+def mission_centroids(bands, mission="sentinel2", hcrf_file=data_utils.HCRF_FILE):
+    return select_centroids(mission_library(mission, hcrf_file=hcrf_file), bands)
+
+
+def reference_library(mission="sentinel2", k=None, hcrf_file=data_utils.HCRF_FILE):
+    references = loaded_library(data_utils.REFERENCES, mission, hcrf_file=hcrf_file)
+    references = data_utils.reference_subset(references, classes=CLASSES)
+    if k is None:
+        k = SCALE_FACTORS.get(mission, SCALE_FACTORS["sentinel2"])
+    return references._replace(values=k*references.values)
+
+
+def reference_index(references, bands, neighbours=NEIGHBOURS):
+    from scipy.spatial import cKDTree
+
+    references = data_utils.reference_subset(references, bands=bands)
+    return {
+        "tree": cKDTree(references.values),
+        "labels": references.labels,
+        "classes": numpy.arange(len(references.classes)),
+        "neighbours": min(neighbours, len(references.labels))
+    }
+
+
+def raster_bands(IMAGES):
+    return [x for x in IMAGES.keys() if isinstance(x, int)]
+
+
+def stack_bands(IMAGES, bands):
+    # All bands are sampled on the grid of the first one, like the per-pixel loop did.
+    first = IMAGES[bands[0]]
+    rows, cols = first.shape
+    stack = numpy.empty([rows, cols, len(bands)], dtype=first.dtype)
+    for n, band in enumerate(bands):
+        stack[:, :, n] = IMAGES[band][:rows, :cols]
+
+    return stack
+
+
+def quantize(values):
+    return numpy.clip(numpy.rint(numpy.asarray(values)*QUANT_SCALE), 0, numpy.iinfo(numpy.uint16).max).astype(numpy.uint16)
+
+
+def minimum_distance(stack, centroids, precision=DEFAULT_PRECISION):
+    # ||p - c||^2 = ||p||^2 - 2p.c + ||c||^2, and ||p||^2 is the same for every class, so the
+    # label is the argmin of ||c||^2 - 2p.c: one matrix product per chunk of pixels.
+    if precision == "uint16":
+        # Products of uint16 values summed over a few bands stay far below 2^53, so float64
+        # holds these integer distances exactly while the product still runs through BLAS.
+        dtype = numpy.float64
+        centroids = quantize(centroids).astype(dtype)
+    else:
+        dtype = numpy.dtype(precision)
+        centroids = numpy.asarray(centroids, dtype=dtype)
+    norms = numpy.einsum("ij,ij->i", centroids, centroids)
+
+    pixels = stack.reshape(-1, stack.shape[-1])
+    labels = numpy.empty(pixels.shape[0], dtype=numpy.uint8)
+    with profile_utils.stage("minimum_distance", pixels=pixels.shape[0], bands=pixels.shape[1], classes=len(centroids),
+                             precision=precision):
+        for start in range(0, pixels.shape[0], CHUNK_PIXELS):
+            chunk = pixels[start:start + CHUNK_PIXELS]
+            nodata = ~chunk.any(axis=1)
+            if precision == "uint16" and chunk.dtype != numpy.uint16:
+                chunk = quantize(chunk)
+            scores = norms - 2*(chunk.astype(dtype, copy=False) @ centroids.T)
+            out = labels[start:start + CHUNK_PIXELS]
+            numpy.add(scores.argmin(axis=1), 1, out=out, casting="unsafe")
+            out[nodata] = NODATA_LABEL
+
+    return labels.reshape(stack.shape[:-1])
+
+
+def nearest_reference(pixels, index, precision=DEFAULT_PRECISION):
+    # Each pixel takes the class most of its nearest reference spectra belong to. Nearer spectra weigh a little
+    # more (the extra weights sum to less than one vote), so ties go to the class whose spectra rank nearer.
+    # The k-d tree is queried in float64 whatever the precision, one chunk of pixels at a time.
+    tree, neighbours = index["tree"], index["neighbours"]
+    weights = 1 + (neighbours - numpy.arange(neighbours))/neighbours**2
+    labels = numpy.empty(pixels.shape[0], dtype=numpy.uint8)
+    with profile_utils.stage("nearest_reference", pixels=pixels.shape[0], bands=pixels.shape[1], references=tree.n,
+                             neighbours=neighbours):
+        for start in range(0, pixels.shape[0], CHUNK_PIXELS):
+            chunk = pixels[start:start + CHUNK_PIXELS]
+            nearest = tree.query(chunk.astype(numpy.float64), k=neighbours)[1].reshape(len(chunk), neighbours)
+            votes = index["labels"][nearest]
+            counts = ((votes[:, :, None] == index["classes"])*weights[:, None]).sum(axis=1)
+            out = labels[start:start + CHUNK_PIXELS]
+            numpy.add(counts.argmax(axis=1), 1, out=out, casting="unsafe")
+            out[~chunk.any(axis=1)] = NODATA_LABEL
+
+    return labels
+
+
+BACKENDS = {
+    "minimum_distance": Backend(mission_library, select_centroids, minimum_distance),
+    "nearest_reference": Backend(reference_library, reference_index, nearest_reference)
+}
+DEFAULT_BACKEND = "minimum_distance"
+
+
+def create_classifier(bands, mission="sentinel2", backend=DEFAULT_BACKEND, library=None,
+                      hcrf_file=data_utils.HCRF_FILE):
+    if library is None:
+        library = BACKENDS[backend].library(mission, hcrf_file=hcrf_file)
+    return Classifier(backend, BACKENDS[backend].model(library, bands))
+
+
+def classify_pixels(classifier, pixels, precision=DEFAULT_PRECISION):
+    return BACKENDS[classifier.backend].classify(pixels, classifier.model, precision)
+
+
+def precision_mismatches(stack, centroids, precision=DEFAULT_PRECISION):
+    # Labels that differ from an exact float64 evaluation are ties when the two squared distances are
+    # closer than the rounding error of the kernel: float epsilon for the float kernels, half a
+    # quantization step per band for uint16.
+    pixels = stack.reshape(-1, stack.shape[-1]).astype(numpy.float64)
+    centroids = numpy.asarray(centroids, dtype=numpy.float64)
+    distances = numpy.stack([numpy.square(pixels - x).sum(axis=1) for x in centroids], axis=1)
+    reference = distances.argmin(axis=1) + 1
+    reference[~pixels.any(axis=1)] = NODATA_LABEL
+
+    labels = minimum_distance(stack, centroids, precision=precision).ravel()
+    differ = numpy.flatnonzero(labels != reference)
+    valid = differ[labels[differ] != NODATA_LABEL]
+    p = pixels[valid]
+    a = centroids[reference[valid] - 1]
+    b = centroids[labels[valid] - 1]
+    gap = numpy.abs(distances[valid, labels[valid] - 1] - distances[valid, reference[valid] - 1])
+    if precision == "uint16":
+        step = 1.0/QUANT_SCALE
+        bound = 2*step*(numpy.abs(p - a).sum(axis=1) + numpy.abs(p - b).sum(axis=1)) + 2*p.shape[1]*step**2
+    else:
+        eps = numpy.finfo(numpy.dtype(precision)).eps
+        bound = 4*p.shape[1]*eps*(numpy.square(p).sum(axis=1) + numpy.square(a).sum(axis=1) + numpy.square(b).sum(axis=1))
+
+    return len(differ), int((gap <= bound).sum())
+
+
+def valid_pixels(stack, georef=None, cutline=None, window=None):
+    valid = stack.any(axis=-1)
+    if cutline is not None:
+        valid &= image_utils.rasterize_cutline(cutline, georef, window=window)
+    return valid
+
+
+def classify_valid(stack, classifier, valid, precision=DEFAULT_PRECISION):
+    # Only the valid pixels are packed into a dense (N, B) array and classified, then scattered back
+    labels = numpy.full(valid.shape, NODATA_LABEL, dtype=numpy.uint8)
+    labels[valid] = classify_pixels(classifier, stack[valid], precision=precision)
+    return labels
+
+
+def classify_raster(IMAGES, mission="sentinel2", precision=DEFAULT_PRECISION, mask=None, backend=DEFAULT_BACKEND):
+    bands = raster_bands(IMAGES)
+    classifier = create_classifier(bands, mission=mission, backend=backend)
+    stack = stack_bands(IMAGES, bands)
+    cutline = image_utils.open_cutline(mask) if mask is not None else None
+    return classify_valid(stack, classifier, valid_pixels(stack, IMAGES["georeference"], cutline), precision=precision)
+
+
+def sweep_parameters(source_dir, mission="sentinel2", scale_factors=None, kmax_values=None, cache_dir=None,
+                     precision=DEFAULT_PRECISION, hcrf_file=data_utils.HCRF_FILE):
+    # The band stack is decoded once; dividing the pixels by another kmax gives the same labels as
+    # multiplying the centroids by kmax/kmax_cached, so every run is only a distance step.
+    stack, header = image_utils.cached_stack(source_dir, mission=mission, cache_dir=cache_dir)
+    centroids = select_centroids(mission_library(mission, k=1, hcrf_file=hcrf_file), header["bands"])
+    if scale_factors is None:
+        scale_factors = [SCALE_FACTORS.get(mission, SCALE_FACTORS["sentinel2"])]
+    if kmax_values is None:
+        kmax_values = [header["kmax"]]
+
+    valid = valid_pixels(stack)
+    pixels = stack[valid]
+    for kmax in kmax_values:
+        for k in scale_factors:
+            labels = numpy.full(valid.shape, NODATA_LABEL, dtype=numpy.uint8)
+            labels[valid] = minimum_distance(pixels, k*kmax/header["kmax"]*centroids, precision=precision)
+            yield k, kmax, labels
+
+
+def _block_state(datasets, classifier, mission, precision, mask):
+    return {
+        "datasets": datasets,
+        "georef": image_utils.georeference(datasets[0]),
+        "cutline": image_utils.open_cutline(mask) if mask is not None else None,
+        "classifier": classifier,
+        "mission": mission,
+        "precision": precision
+    }
+
+
+def _classify_window(state, window):
+    stack = image_utils.read_window(state["datasets"], window, mission=state["mission"])
+    valid = valid_pixels(stack, state["georef"], state["cutline"], window=window)
+    return window, classify_valid(stack, state["classifier"], valid, precision=state["precision"])
+
+
+def _init_block_worker(source_dir, classifier, mission, precision, mask):
+    bands, datasets = image_utils.open_bands(source_dir)
+    _WORKER.update(_block_state(datasets, classifier, mission, precision, mask))
+
+
+def _classify_block(window):
+    return _classify_window(_WORKER, window)
+
+
+def _classify_blocks(source_dir, datasets, windows, classifier, mission, workers, precision, mask):
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_block_worker,
+                                 initargs=(source_dir, classifier, mission, precision, mask)) as pool:
+            yield from pool.map(_classify_block, windows)
+    else:
+        state = _block_state(datasets, classifier, mission, precision, mask)
+        for window in windows:
+            yield _classify_window(state, window)
+
+
+def classify_tiled(source_dir, output="Classification.tif", mission="sentinel2", block_size=image_utils.BLOCK_SIZE,
+                   workers=1, library=None, precision=DEFAULT_PRECISION, mask=None, backend=DEFAULT_BACKEND,
+                   hcrf_file=data_utils.HCRF_FILE):
+    bands, datasets = image_utils.open_bands(source_dir)
+    if datasets is None:
+        return None
+
+    classifier = create_classifier(bands, mission=mission, backend=backend, library=library, hcrf_file=hcrf_file)
+    reference = datasets[0]
+    dst = image_utils.create_label_raster(output, image_utils.georeference(reference), nodata=NODATA_LABEL,
+                                          palette=label_palette())
+    dst_band = dst.GetRasterBand(1)
+    nr_pixels = {x: 0 for x in range(1, len(CLASSES) + 1)}
+
+    windows = list(image_utils.iter_windows(reference.RasterXSize, reference.RasterYSize, block_size))
+    with profile_utils.stage("classify_tiled", source_dir=source_dir, blocks=len(windows), workers=workers,
+                             pixels=reference.RasterXSize*reference.RasterYSize):
+        blocks = _classify_blocks(source_dir, datasets, windows, classifier, mission, workers, precision, mask)
+        for window, labels in blocks:
+            dst_band.WriteArray(labels, window[0], window[1])
+            for label, count in count_pixels(labels).items():
+                nr_pixels[label] += count
+
+    dst_band = None
+    image_utils.close_label_raster(dst, output)
+    return nr_pixels
+
+
+def _init_scene_worker(library, mission, block_size, backend):
+    _WORKER.update(library=library, mission=mission, block_size=block_size, backend=backend)
+
+
+def _classify_scene(scene):
+    source_dir, output = scene
+    nr_pixels = classify_tiled(source_dir, output, mission=_WORKER["mission"], block_size=_WORKER["block_size"],
+                               library=_WORKER["library"], backend=_WORKER["backend"])
+    return source_dir, nr_pixels
+
+
+def iter_scenes(scenes, mission="sentinel2", block_size=image_utils.BLOCK_SIZE, workers=None, backend=DEFAULT_BACKEND,
+                hcrf_file=data_utils.HCRF_FILE):
+    library = BACKENDS[backend].library(mission, hcrf_file=hcrf_file)
+    if workers is None:
+        workers = os.cpu_count()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_scene_worker,
+                                 initargs=(library, mission, block_size, backend)) as pool:
+            yield from pool.map(_classify_scene, scenes)
+    else:
+        _init_scene_worker(library, mission, block_size, backend)
+        yield from map(_classify_scene, scenes)
+
+
+def classify_scenes(source_dir, output_dir, mission="sentinel2", block_size=image_utils.BLOCK_SIZE, workers=None,
+                    backend=DEFAULT_BACKEND, hcrf_file=data_utils.HCRF_FILE):
+    scenes = []
+    for scene_dir in sorted(glob.glob(os.path.join(source_dir, "*_cropped"))):
+        name = os.path.basename(scene_dir)[:-len("_cropped")]
+        scenes.append((scene_dir, os.path.join(output_dir, name + ".tif")))
+    os.makedirs(output_dir, exist_ok=True)
+
+    return dict(iter_scenes(scenes, mission=mission, block_size=block_size, workers=workers, backend=backend,
+                            hcrf_file=hcrf_file))
+
+
+def label_palette():
+    # Index 0 is the no data label, drawn with the colour of the area outside snow/ice
+    return numpy.array([data_utils.COLORS[6]] + [data_utils.COLORS[x] for x in range(1, len(CLASSES) + 1)],
+                       dtype=numpy.uint8)
+
+
+def label_colors(labels):
+    return label_palette()[labels]
+
+
+def count_pixels(labels):
+    counts = numpy.bincount(labels.ravel(), minlength=len(CLASSES) + 1)
+    return {x: int(counts[x]) for x in range(1, len(CLASSES) + 1)}
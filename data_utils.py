@@ -2,38 +2,34 @@
 This module contains a set of functions that parse the training data set and
 compute the centers for the data clusters.
 Here you will also find dictionaries contatining Sentinel2 and Landsat7/8
-bands, as well as distionaries containing the mean values for each class.
+bands, as well as the spectral library holding the mean values of each
+class for every mission and the reference library holding the spectrum of
+every training site.
 """
 
 import numpy as np
-import pandas as pd
 import os
-import matplotlib.pyplot as plt
+import json
+import hashlib
+from collections import namedtuple
+import profile_utils
+import image_utils
 
 
-HCRF_FILE = os.path.join(os.getcwd(), 'TrainingData', 'TrainingData.csv')
-SAVEFIG_PATH = os.getcwd()
+# Relative paths are resolved when they are used; pandas and matplotlib are only imported where needed
+HCRF_FILE = os.path.join('TrainingData', 'TrainingData.csv')
+SAVEFIG_PATH = None
+FIRST_WAVELENGTH = 350
 
-HA = {}
-LA = {}
-CI = {}
-CC = {}
-WAT = {}
-SN = {}
+# One contiguous (classes x bands) array per mission, with index maps for class names and band IDs
+SpectralLibrary = namedtuple("SpectralLibrary", ["values", "classes", "bands"])
+LIBRARY = {}
 
-HA_L8 = {}
-LA_L8 = {}
-CI_L8 = {}
-CC_L8 = {}
-WAT_L8 = {}
-SN_L8 = {}
+# One (sites x bands) array per mission, with the class index of every site
+ReferenceLibrary = namedtuple("ReferenceLibrary", ["values", "labels", "classes", "bands"])
+REFERENCES = {}
 
-HA_L7 = {}
-LA_L7 = {}
-CI_L7 = {}
-CC_L7 = {}
-WAT_L7 = {}
-SN_L7 = {}
+CLASS_NAMES = ["HA", "LA", "CI", "CC", "WAT", "SN"]
 
 BANDS = {
     1: [433, 453],
@@ -72,163 +68,260 @@ BANDS_LANDSAT_7 = {
     8: [520, 900]
 }
 
-def plot_training_spectra(BANDS, HA, LA, CI, CC, WAT, SN, mission="Sentinel2"):
+MISSION_BANDS = {
+    "sentinel2": BANDS,
+    "landsat8": BANDS_LANDSAT_8,
+    "landsat7": BANDS_LANDSAT_7
+}
+
+# Site groups that replace the default group of a class for a given mission
+SITE_OVERRIDES = {
+    "sentinel2": {"HA": "HA_S2", "LA": "LA_S2"}
+}
+
+SPECTRA_STYLES = {
+    "HA": ('o:g', "High Algae"),
+    "LA": ('o:y', "Low Algae"),
+    "CI": ('o:b', "Clean Ice"),
+    "CC": ('o:m', "Cryoconite"),
+    "WAT": ('o:k', "Water"),
+    "SN": ('o:c', "Snow")
+}
+
+# Site names grouped according to surface class
+HAsites = ['5_8_16_site2_ice7', '5_8_16_site3_ice2', '5_8_16_site3_ice3',
+           '5_8_16_site3_ice5', '5_8_16_site3_ice6', '5_8_16_site3_ice7', '5_8_16_site3_ice8',
+           '5_8_16_site3_ice9',  '14_7_SB3', '14_7_SB7', '15_7_S2',
+            '13_7_S1', '13_7_S3']
+
+LAsites = ['14_7_S2', '14_7_S3', '14_7_SB2', '14_7_SB3', '14_7_SB7', '15_7_S2',
+           '15_7_SB4', '20_7_SB1', '20_7_SB3', '21_7_S1', '21_7_S5', '21_7_SB4', '22_7_SB2',
+           '22_7_SB3', '22_7_S1', '23_7_S1', '23_7_S2', '24_7_S2', 'MA_1', 'MA_2', 'MA_3',
+           'MA_5', 'MA_6', 'MA_8', 'MA_9', 'MA_10', 'MA_12', 'MA_13', 'MA_16', 'MA_19',
+           '13_7_S1', '13_7_S3', '14_7_S1', '15_7_S1', '15_7_SB2', '20_7_SB2', '21_7_SB5',
+           '21_7_SB8', '25_7_S3', '5_8_16_site2_ice10', '5_8_16_site2_ice5',
+           '5_8_16_site2_ice9', '27_7_16_SITE3_WHITE3']
+
+CIsites = ['21_7_S4', '13_7_SB3', '15_7_S4', '15_7_SB1', '15_7_SB5', '21_7_S2',
+           '21_7_SB3', '22_7_S2', '22_7_S4', '23_7_SB1', '23_7_SB2', '23_7_S4',
+           'WI_1', 'WI_2', 'WI_4', 'WI_5', 'WI_6', 'WI_7', 'WI_9', 'WI_10', 'WI_11',
+           'WI_12', 'WI_13', '27_7_16_SITE3_WHITE1', '27_7_16_SITE3_WHITE2',
+           '27_7_16_SITE2_ICE2', '27_7_16_SITE2_ICE4', '27_7_16_SITE2_ICE6',
+           '5_8_16_site2_ice1', '5_8_16_site2_ice2', '5_8_16_site2_ice3',
+           '5_8_16_site2_ice4', '5_8_16_site2_ice6', '5_8_16_site2_ice8',
+           '5_8_16_site3_ice1', '5_8_16_site3_ice4']
+
+CCsites = ['DISP1', 'DISP2', 'DISP3', 'DISP4', 'DISP5', 'DISP6', 'DISP7', 'DISP8',
+           'DISP9', 'DISP10', 'DISP11', 'DISP12', 'DISP13', 'DISP14', '27_7_16_SITE3_DISP1',
+           '27_7_16_SITE3_DISP3']
+
+WATsites = ['21_7_SB5', '21_7_SB8', 'WAT_1', 'WAT_3', 'WAT_6']
+
+SNsites = ['14_7_S4', '14_7_SB6', '14_7_SB8', '17_7_SB2', 'SNICAR100', 'SNICAR200',
+           'SNICAR300', 'SNICAR400', 'SNICAR500', 'SNICAR600', 'SNICAR700', 'SNICAR800',
+           'SNICAR900', 'SNICAR1000', '27_7_16_KANU_', '27_7_16_SITE2_1',
+           '5_8_16_site1_snow10', '5_8_16_site1_snow2', '5_8_16_site1_snow3',
+           '5_8_16_site1_snow4', '5_8_16_site1_snow6', '5_8_16_site1_snow7',
+           '5_8_16_site1_snow9']
+
+HAsites_S2 = ['13_7_SB2', '13_7_SB4', '14_7_S5', '14_7_SB1', '14_7_SB5', '14_7_SB10',
+           '15_7_SB3', '21_7_SB1', '21_7_SB7', '22_7_SB4', '22_7_SB5', '22_7_S3', '22_7_S5',
+           '23_7_SB3', '23_7_SB5', '23_7_S3', '23_7_SB4', '24_7_SB2', 'HA_1', 'HA_2', 'HA_3',
+           'HA_4', 'HA_5', 'HA_6', 'HA_7', 'HA_8', 'HA_10', 'HA_11', 'HA_12', 'HA_13', 'HA_14',
+           'HA_15', 'HA_16', 'HA_17', 'HA_18', 'HA_19', 'HA_20', 'HA_21', 'HA_22', 'HA_24',
+           'HA_25', 'HA_26', 'HA_27', 'HA_28', 'HA_29', 'HA_30', 'HA_31', '13_7_S2', '14_7_SB9',
+           'MA_11', 'MA_14', 'MA_15', 'MA_17', '21_7_SB2', '22_7_SB1', 'MA_4', 'MA_7', 'MA_18',
+           '27_7_16_SITE3_WMELON1', '27_7_16_SITE3_WMELON3', '27_7_16_SITE2_ALG1',
+           '27_7_16_SITE2_ALG2', '27_7_16_SITE2_ALG3', '27_7_16_SITE2_ICE3', '27_7_16_SITE2_ICE5',
+           '27_7_16_SITE3_ALG4', '5_8_16_site2_ice7', '5_8_16_site3_ice2', '5_8_16_site3_ice3',
+           '5_8_16_site3_ice5', '5_8_16_site3_ice6', '5_8_16_site3_ice7', '5_8_16_site3_ice8',
+           '5_8_16_site3_ice9']
+
+LAsites_S2 = ['14_7_S2', '14_7_S3', '14_7_SB2', '14_7_SB3', '14_7_SB7', '15_7_S2',
+           '15_7_SB4', '20_7_SB1', '20_7_SB3', '21_7_S1', '21_7_S5', '21_7_SB4', '22_7_SB2',
+           '22_7_SB3', '22_7_S1', '23_7_S1', '23_7_S2', '24_7_S2', 'MA_1', 'MA_2', 'MA_3',
+           'MA_5', 'MA_6', 'MA_8', 'MA_9', 'MA_10', 'MA_12', 'MA_13', 'MA_16', 'MA_19',
+           '13_7_S1', '13_7_S3', '14_7_S1', '15_7_S1', '15_7_SB2', '20_7_SB2', '21_7_SB5',
+           '21_7_SB8', '25_7_S3', '5_8_16_site2_ice10', '5_8_16_site2_ice5',
+           '5_8_16_site2_ice9', '27_7_16_SITE3_WHITE3']
+
+SITES = {
+    "HA": HAsites,
+    "LA": LAsites,
+    "CI": CIsites,
+    "CC": CCsites,
+    "WAT": WATsites,
+    "SN": SNsites,
+    "HA_S2": HAsites_S2,
+    "LA_S2": LAsites_S2
+}
+
+
+def plot_training_spectra(library, mission="Sentinel2"):
+    import matplotlib.pyplot as plt
+
     ax = plt.subplot(1, 1, 1)
-    xpoints = BANDS.keys()
-    plt.plot(xpoints, HA.values(), 'o:g', label="High Algae")
-    plt.plot(xpoints, LA.values(), 'o:y', label="Low Algae")
-    plt.plot(xpoints, CI.values(), 'o:b', label="Clean Ice")
-    plt.plot(xpoints, CC.values(), 'o:m', label="Cryoconite")
-    plt.plot(xpoints, WAT.values(), 'o:k', label="Water")
-    plt.plot(xpoints, SN.values(), 'o:c', label="Snow")
+    xpoints = list(library.bands.keys())
+    for name, row in library.classes.items():
+        style, label = SPECTRA_STYLES.get(name, ('o:', name))
+        plt.plot(xpoints, library.values[row], style, label=label)
     handles, labels = ax.get_legend_handles_labels()
     ax.legend(labels)
     plt.grid()
     plt.xlabel("{} bands".format(mission))
     plt.ylabel("Albedo")
     plt.title("Spectra of training data")
-    plt.savefig(os.path.join(SAVEFIG_PATH, 'TrainingSpectra{}.png'.format(mission)))
+    plt.savefig(os.path.join(SAVEFIG_PATH or os.getcwd(), 'TrainingSpectra{}.png'.format(mission)))
     plt.close()
 
-def create_dataset(file=HCRF_FILE, savefig=True):
-    hcrf_master = pd.read_csv(file)
-    HA_hcrf = pd.DataFrame()
-    LA_hcrf = pd.DataFrame()
-    HA_hcrf_S2 = pd.DataFrame()
-    LA_hcrf_S2 = pd.DataFrame()
-    CI_hcrf = pd.DataFrame()
-    CC_hcrf = pd.DataFrame()
-    WAT_hcrf = pd.DataFrame()
-    SN_hcrf = pd.DataFrame()
-
-    # Group site names according to surface class
-
-    HAsites = ['5_8_16_site2_ice7', '5_8_16_site3_ice2', '5_8_16_site3_ice3',
-               '5_8_16_site3_ice5', '5_8_16_site3_ice6', '5_8_16_site3_ice7', '5_8_16_site3_ice8',
-               '5_8_16_site3_ice9',  '14_7_SB3', '14_7_SB7', '15_7_S2',
-                '13_7_S1', '13_7_S3']
-
-    LAsites = ['14_7_S2', '14_7_S3', '14_7_SB2', '14_7_SB3', '14_7_SB7', '15_7_S2',
-               '15_7_SB4', '20_7_SB1', '20_7_SB3', '21_7_S1', '21_7_S5', '21_7_SB4', '22_7_SB2',
-               '22_7_SB3', '22_7_S1', '23_7_S1', '23_7_S2', '24_7_S2', 'MA_1', 'MA_2', 'MA_3',
-               'MA_5', 'MA_6', 'MA_8', 'MA_9', 'MA_10', 'MA_12', 'MA_13', 'MA_16', 'MA_19',
-               '13_7_S1', '13_7_S3', '14_7_S1', '15_7_S1', '15_7_SB2', '20_7_SB2', '21_7_SB5',
-               '21_7_SB8', '25_7_S3', '5_8_16_site2_ice10', '5_8_16_site2_ice5',
-               '5_8_16_site2_ice9', '27_7_16_SITE3_WHITE3']
-
-    CIsites = ['21_7_S4', '13_7_SB3', '15_7_S4', '15_7_SB1', '15_7_SB5', '21_7_S2',
-               '21_7_SB3', '22_7_S2', '22_7_S4', '23_7_SB1', '23_7_SB2', '23_7_S4',
-               'WI_1', 'WI_2', 'WI_4', 'WI_5', 'WI_6', 'WI_7', 'WI_9', 'WI_10', 'WI_11',
-               'WI_12', 'WI_13', '27_7_16_SITE3_WHITE1', '27_7_16_SITE3_WHITE2',
-               '27_7_16_SITE2_ICE2', '27_7_16_SITE2_ICE4', '27_7_16_SITE2_ICE6',
-               '5_8_16_site2_ice1', '5_8_16_site2_ice2', '5_8_16_site2_ice3',
-               '5_8_16_site2_ice4', '5_8_16_site2_ice6', '5_8_16_site2_ice8',
-               '5_8_16_site3_ice1', '5_8_16_site3_ice4']
-
-    CCsites = ['DISP1', 'DISP2', 'DISP3', 'DISP4', 'DISP5', 'DISP6', 'DISP7', 'DISP8',
-               'DISP9', 'DISP10', 'DISP11', 'DISP12', 'DISP13', 'DISP14', '27_7_16_SITE3_DISP1',
-               '27_7_16_SITE3_DISP3']
-
-    WATsites = ['21_7_SB5', '21_7_SB8', 'WAT_1', 'WAT_3', 'WAT_6']
-
-    SNsites = ['14_7_S4', '14_7_SB6', '14_7_SB8', '17_7_SB2', 'SNICAR100', 'SNICAR200',
-               'SNICAR300', 'SNICAR400', 'SNICAR500', 'SNICAR600', 'SNICAR700', 'SNICAR800',
-               'SNICAR900', 'SNICAR1000', '27_7_16_KANU_', '27_7_16_SITE2_1',
-               '5_8_16_site1_snow10', '5_8_16_site1_snow2', '5_8_16_site1_snow3',
-               '5_8_16_site1_snow4', '5_8_16_site1_snow6', '5_8_16_site1_snow7',
-               '5_8_16_site1_snow9']
-
-    HAsites_S2 = ['13_7_SB2', '13_7_SB4', '14_7_S5', '14_7_SB1', '14_7_SB5', '14_7_SB10',
-               '15_7_SB3', '21_7_SB1', '21_7_SB7', '22_7_SB4', '22_7_SB5', '22_7_S3', '22_7_S5',
-               '23_7_SB3', '23_7_SB5', '23_7_S3', '23_7_SB4', '24_7_SB2', 'HA_1', 'HA_2', 'HA_3',
-               'HA_4', 'HA_5', 'HA_6', 'HA_7', 'HA_8', 'HA_10', 'HA_11', 'HA_12', 'HA_13', 'HA_14',
-               'HA_15', 'HA_16', 'HA_17', 'HA_18', 'HA_19', 'HA_20', 'HA_21', 'HA_22', 'HA_24',
-               'HA_25', 'HA_26', 'HA_27', 'HA_28', 'HA_29', 'HA_30', 'HA_31', '13_7_S2', '14_7_SB9',
-               'MA_11', 'MA_14', 'MA_15', 'MA_17', '21_7_SB2', '22_7_SB1', 'MA_4', 'MA_7', 'MA_18',
-               '27_7_16_SITE3_WMELON1', '27_7_16_SITE3_WMELON3', '27_7_16_SITE2_ALG1',
-               '27_7_16_SITE2_ALG2', '27_7_16_SITE2_ALG3', '27_7_16_SITE2_ICE3', '27_7_16_SITE2_ICE5',
-               '27_7_16_SITE3_ALG4', '5_8_16_site2_ice7', '5_8_16_site3_ice2', '5_8_16_site3_ice3',
-               '5_8_16_site3_ice5', '5_8_16_site3_ice6', '5_8_16_site3_ice7', '5_8_16_site3_ice8',
-               '5_8_16_site3_ice9']
-
-    LAsites_S2 = ['14_7_S2', '14_7_S3', '14_7_SB2', '14_7_SB3', '14_7_SB7', '15_7_S2',
-               '15_7_SB4', '20_7_SB1', '20_7_SB3', '21_7_S1', '21_7_S5', '21_7_SB4', '22_7_SB2',
-               '22_7_SB3', '22_7_S1', '23_7_S1', '23_7_S2', '24_7_S2', 'MA_1', 'MA_2', 'MA_3',
-               'MA_5', 'MA_6', 'MA_8', 'MA_9', 'MA_10', 'MA_12', 'MA_13', 'MA_16', 'MA_19',
-               '13_7_S1', '13_7_S3', '14_7_S1', '15_7_S1', '15_7_SB2', '20_7_SB2', '21_7_SB5',
-               '21_7_SB8', '25_7_S3', '5_8_16_site2_ice10', '5_8_16_site2_ice5',
-               '5_8_16_site2_ice9', '27_7_16_SITE3_WHITE3']
-
-    for i in HAsites:
-        hcrf_HA = np.array(hcrf_master[i])
-        HA_hcrf['{}'.format(i)] = hcrf_HA
-
-    for i in HAsites_S2:
-        hcrf_HA = np.array(hcrf_master[i])
-        HA_hcrf_S2['{}'.format(i)] = hcrf_HA
-
-    for ii in LAsites:
-        hcrf_LA = np.array(hcrf_master[ii])
-        LA_hcrf['{}'.format(ii)] = hcrf_LA
-
-    for ii in LAsites_S2:
-        hcrf_LA = np.array(hcrf_master[ii])
-        LA_hcrf_S2['{}'.format(ii)] = hcrf_LA
-
-    for iii in CIsites:
-        hcrf_CI = np.array(hcrf_master[iii])
-        CI_hcrf['{}'.format(iii)] = hcrf_CI
-
-    for iv in CCsites:
-        hcrf_CC = np.array(hcrf_master[iv])
-        CC_hcrf['{}'.format(iv)] = hcrf_CC
-
-    for v in WATsites:
-        hcrf_WAT = np.array(hcrf_master[v])
-        WAT_hcrf['{}'.format(v)] = hcrf_WAT
-
-    for vi in SNsites:
-        hcrf_SN = np.array(hcrf_master[vi])
-        SN_hcrf['{}'.format(vi)] = hcrf_SN
-
-    for band in BANDS.keys():
-        min_wl_index = BANDS[band][0] - 350
-        max_wl_index = BANDS[band][1] - 350
-
-        HA[band] = HA_hcrf_S2[min_wl_index:max_wl_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        LA[band] = LA_hcrf_S2[min_wl_index:max_wl_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        CI[band] = CI_hcrf[min_wl_index:max_wl_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        CC[band] = CC_hcrf[min_wl_index:max_wl_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        WAT[band] = WAT_hcrf[min_wl_index:max_wl_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        SN[band] = SN_hcrf[min_wl_index:max_wl_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-
-    for band in BANDS_LANDSAT_8.keys():
-        min_l8_index = BANDS_LANDSAT_8[band][0] - 350
-        max_l8_index = BANDS_LANDSAT_8[band][1] - 350
-
-        HA_L8[band] = HA_hcrf[min_l8_index:max_l8_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        LA_L8[band] = LA_hcrf[min_l8_index:max_l8_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        CI_L8[band] = CI_hcrf[min_l8_index:max_l8_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        CC_L8[band] = CC_hcrf[min_l8_index:max_l8_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        WAT_L8[band] = WAT_hcrf[min_l8_index:max_l8_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        SN_L8[band] = SN_hcrf[min_l8_index:max_l8_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-
-    for band in BANDS_LANDSAT_7.keys():
-        min_l7_index = BANDS_LANDSAT_7[band][0] - 350
-        max_l7_index = BANDS_LANDSAT_7[band][1] - 350
-
-        HA_L7[band] = HA_hcrf[min_l7_index:max_l7_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        LA_L7[band] = LA_hcrf[min_l7_index:max_l7_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        CI_L7[band] = CI_hcrf[min_l7_index:max_l7_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        CC_L7[band] = CC_hcrf[min_l7_index:max_l7_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        WAT_L7[band] = WAT_hcrf[min_l7_index:max_l7_index].mean(axis='columns').mean(axis='index').astype(np.float64)
-        SN_L7[band] = SN_hcrf[min_l7_index:max_l7_index].mean(axis='columns').mean(axis='index').astype(np.float64)
 
+def plot_all_spectra():
+    for mission, library in LIBRARY.items():
+        plot_training_spectra(library, mission=mission.capitalize())
+
+
+def library_subset(library, classes=None, bands=None):
+    if classes is None:
+        classes = list(library.classes.keys())
+    if bands is None:
+        bands = list(library.bands.keys())
+    values = library.values[np.ix_([library.classes[x] for x in classes], [library.bands[x] for x in bands])]
+    return SpectralLibrary(np.ascontiguousarray(values),
+                           {x: n for n, x in enumerate(classes)},
+                           {x: n for n, x in enumerate(bands)})
+
+
+def reference_subset(references, classes=None, bands=None):
+    # Keeps the sites of the given classes, relabelled with their position in classes
+    if classes is None:
+        classes = list(references.classes.keys())
+    if bands is None:
+        bands = list(references.bands.keys())
+    remap = np.full(len(references.classes), -1)
+    for n, x in enumerate(classes):
+        remap[references.classes[x]] = n
+    labels = remap[references.labels]
+    rows = np.flatnonzero(labels >= 0)
+    values = references.values[np.ix_(rows, [references.bands[x] for x in bands])]
+    return ReferenceLibrary(np.ascontiguousarray(values), labels[rows],
+                            {x: n for n, x in enumerate(classes)},
+                            {x: n for n, x in enumerate(bands)})
+
+
+def reference_sites(mission):
+    overrides = SITE_OVERRIDES.get(mission, {})
+    return [(n, site) for n, x in enumerate(CLASS_NAMES) for site in SITES[overrides.get(x, x)]]
+
+
+def group_spectra(hcrf_master, groups):
+    # Mean spectrum of every site group, computed as one product with a (groups x sites) weight matrix
+    columns = sorted({x for name in groups for x in SITES[name]})
+    index = {x: n for n, x in enumerate(columns)}
+    weights = np.zeros([len(groups), len(columns)], dtype=np.float64)
+    for row, name in enumerate(groups):
+        weights[row, [index[x] for x in SITES[name]]] = 1.0/len(SITES[name])
+
+    return weights @ hcrf_master[columns].to_numpy(dtype=np.float64).T
+
+
+def band_means(cumulative, band_defs):
+    lower = np.array([x[0] for x in band_defs.values()]) - FIRST_WAVELENGTH
+    upper = np.array([x[1] for x in band_defs.values()]) - FIRST_WAVELENGTH
+    return (cumulative[:, upper] - cumulative[:, lower])/(upper - lower)
+
+
+def create_dataset(file=HCRF_FILE, savefig=False):
+    import pandas as pd
+
+    with profile_utils.stage("create_dataset", file=file, bytes_read=os.path.getsize(file)):
+        hcrf_master = pd.read_csv(file)
+        groups = list(SITES.keys())
+        spectra = group_spectra(hcrf_master, groups)
+
+        # Cumulative sums over the wavelength axis turn every band mean into a single subtraction
+        cumulative = np.zeros([len(groups), spectra.shape[1] + 1], dtype=np.float64)
+        np.cumsum(spectra, axis=1, out=cumulative[:, 1:])
+
+        # Every training site is also kept on its own, as a reference spectrum labelled with its class
+        sites = {x: n for n, x in enumerate(sorted({x for name in groups for x in SITES[name]}))}
+        site_cumulative = np.zeros([len(sites), spectra.shape[1] + 1], dtype=np.float64)
+        np.cumsum(hcrf_master[list(sites)].to_numpy(dtype=np.float64).T, axis=1, out=site_cumulative[:, 1:])
+
+        for mission, band_defs in MISSION_BANDS.items():
+            overrides = SITE_OVERRIDES.get(mission, {})
+            rows = [groups.index(overrides.get(x, x)) for x in CLASS_NAMES]
+            LIBRARY[mission] = SpectralLibrary(np.ascontiguousarray(band_means(cumulative[rows], band_defs)),
+                                               {x: n for n, x in enumerate(CLASS_NAMES)},
+                                               {x: n for n, x in enumerate(band_defs)})
+            references = reference_sites(mission)
+            rows = [sites[site] for label, site in references]
+            REFERENCES[mission] = ReferenceLibrary(np.ascontiguousarray(band_means(site_cumulative[rows], band_defs)),
+                                                   np.array([label for label, site in references]),
+                                                   {x: n for n, x in enumerate(CLASS_NAMES)},
+                                                   {x: n for n, x in enumerate(band_defs)})
+
+    if savefig:
+        plot_all_spectra()
+
+    return LIBRARY
+
+
+def training_key(file=HCRF_FILE):
+    digest = image_utils.update_file_hash(hashlib.sha256(), file)
+    digest.update(json.dumps([SITES, MISSION_BANDS, SITE_OVERRIDES, CLASS_NAMES], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def save_centroids(cache, key):
+    arrays = {"key": np.array(key)}
+    for mission, library in LIBRARY.items():
+        arrays[mission] = library.values
+        arrays[mission + "_classes"] = np.array(list(library.classes.keys()))
+        arrays[mission + "_bands"] = np.array(list(library.bands.keys()))
+        arrays[mission + "_references"] = REFERENCES[mission].values
+        arrays[mission + "_reference_labels"] = REFERENCES[mission].labels
+
+    # Write next to the cache and rename, so parallel runs never read a half written file
+    tmp = "{}.{}.tmp".format(cache, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, cache)
+
+
+def read_centroids(cache, key):
+    if not os.path.exists(cache):
+        return False
+
+    with np.load(cache) as stored:
+        # Caches written before the reference library existed are rebuilt
+        if str(stored["key"]) != key or any(x + "_references" not in stored for x in MISSION_BANDS):
+            return False
+        for mission in MISSION_BANDS.keys():
+            classes = {x: n for n, x in enumerate(stored[mission + "_classes"].tolist())}
+            bands = {x: n for n, x in enumerate(stored[mission + "_bands"].tolist())}
+            LIBRARY[mission] = SpectralLibrary(stored[mission], classes, bands)
+            REFERENCES[mission] = ReferenceLibrary(stored[mission + "_references"],
+                                                   stored[mission + "_reference_labels"], classes, bands)
+
+    return True
+
+
+def load_centroids(file=HCRF_FILE, cache=None, savefig=False, rebuild=False):
+    if cache is None:
+        cache = os.path.join(os.path.dirname(file), 'centroids.npz')
+
+    with profile_utils.stage("load_centroids", file=file) as record:
+        key = training_key(file)
+        cached = not rebuild and read_centroids(cache, key)
+        if not cached:
+            create_dataset(file=file)
+            save_centroids(cache, key)
+        record["cached"] = cached
 
     if savefig:
-        plot_training_spectra(BANDS, HA, LA, CI, CC, WAT, SN, mission="Sentinel2")
-        plot_training_spectra(BANDS_LANDSAT_8, HA_L8, LA_L8, CI_L8, CC_L8, WAT_L8, SN_L8, mission="Landsat8")
-        plot_training_spectra(BANDS_LANDSAT_7, HA_L7, LA_L7, CI_L7, CC_L7, WAT_L7, SN_L7, mission="Landsat7")
+        plot_all_spectra()
+
+    return LIBRARY
 
 
 COLORS = {
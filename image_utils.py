@@ -6,14 +6,17 @@ coordinates for cropping.
 """
 
 import os
+import sys
 import glob
-from numpy import asarray
+import json
+import hashlib
 import numpy
-import cv2
-import inspect
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import osr, ogr
 from osgeo import gdal
+import profile_utils
 
 
 BANDS = {
@@ -22,13 +25,130 @@ BANDS = {
     "Sentinel": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B09", "B10", "B11", "B12"]
 }
 
+KMAX = {
+    "sentinel2": 70,
+    "landsat8": 220,
+    "landsat7": 255
+}
+
+# The classifier was tuned on 8 bit decoded images, so 16 bit reflectances are scaled down the same way
+DEPTH_DIVISOR = {
+    "uint8": 1,
+    "uint16": 256,
+    "int16": 256
+}
+
+BLOCK_SIZE = 512
+# Reduction factors of the overviews of the ingested scenes
+OVERVIEW_FACTORS = [2, 4, 8, 16]
+
+# Rasters without a CRS are taken as UTM 32N, the zone of the Corbassiere scenes
+DEFAULT_EPSG = 32632
+LATLON_EPSG = 4326
+
+MASK_FILE = "mask.gpkg"
+STACK_CACHE_DIR = ".stack_cache"
+
+CROP_ERRORS = {
+    1: "could not open image",
+    2: "crop failed",
+    3: "mask failed"
+}
+
+# Coordinate transformations of each thread, keyed by (source CRS, target CRS)
+_TRANSFORMS = threading.local()
+
+
 def log(msg):
     now = datetime.datetime.now()
-    caller = inspect.stack()[1].function
+    caller = sys._getframe(1).f_code.co_name
     print("[{}][{}:{}:{}]: {}".format(caller, now.hour, now.minute, now.second, msg))
 
 
-def crop_images(img_source, img_destination, xmin, ymin, xmax, ymax, mission="sentinel2"):
+def band_images(img_source, band_list):
+    images = []
+    for image in sorted(glob.glob(os.path.join(img_source, "*"))):
+        try:
+            img_names = [x for x in band_list if x in image]
+            img_name = max(img_names, key=len)
+            img_name = int(''.join(c for c in img_name if c.isdigit()))
+        except ValueError:
+            img_name = None
+
+        if img_name is not None:
+            images.append((img_name, image))
+
+    return images
+
+
+def load_cutline(mask=MASK_FILE):
+    # The cutline is read once and kept in memory for all the bands of a scene
+    src = ogr.Open(mask)
+    if src is None:
+        log("ERROR: Could not open mask {}".format(mask))
+        return None
+
+    layer = src.GetLayer(0)
+    geometry = None
+    for feature in layer:
+        shape = feature.GetGeometryRef()
+        geometry = shape.Clone() if geometry is None else geometry.Union(shape)
+
+    cutline = "/vsimem/cutline_{}.geojson".format(os.getpid())
+    dst = ogr.GetDriverByName("GeoJSON").CreateDataSource(cutline)
+    dst_layer = dst.CreateLayer("cutline", srs=layer.GetSpatialRef(), geom_type=geometry.GetGeometryType())
+    dst_feature = ogr.Feature(dst_layer.GetLayerDefn())
+    dst_feature.SetGeometry(geometry)
+    dst_layer.CreateFeature(dst_feature)
+    dst = None
+    return cutline
+
+
+def open_cutline(mask=MASK_FILE):
+    src = gdal.OpenEx(mask, gdal.OF_VECTOR)
+    if src is None:
+        log("ERROR: Could not open mask {}".format(mask))
+    return src
+
+
+def rasterize_cutline(cutline, georef, window=None):
+    # Burns the cutline on the raster grid (or on one window of it), reprojecting it if needed
+    if window is None:
+        window = [0, 0, georef["size"][0], georef["size"][1]]
+    xoff, yoff, xsize, ysize = window
+    ulx, xres, xskew, uly, yskew, yres = georef["geotransform"]
+    dst = gdal.GetDriverByName("MEM").Create("", xsize, ysize, 1, gdal.GDT_Byte)
+    dst.SetGeoTransform((ulx + xoff*xres + yoff*xskew, xres, xskew, uly + xoff*yskew + yoff*yres, yskew, yres))
+    dst.SetProjection(georef["projection"])
+    gdal.Rasterize(dst, cutline, burnValues=[1])
+    return dst.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+def pixel_window(geotransform, xmin, ymin, xmax, ymax):
+    ulx, xres, xskew, uly, yskew, yres = geotransform
+    xoff = int(numpy.floor((xmin - ulx)/xres + 0.001))
+    yoff = int(numpy.floor((ymin - uly)/yres + 0.001))
+    xend = int(numpy.ceil((xmax - ulx)/xres - 0.001))
+    yend = int(numpy.ceil((ymax - uly)/yres - 0.001))
+    return [xoff, yoff, xend - xoff, yend - yoff]
+
+
+def crop_band(src, img_name, img_destination, window, cutline):
+    output_cropped = os.path.join(img_destination + "_cropped", str(img_name) + ".TIF")
+    with profile_utils.stage("crop_band", band=img_name, pixels=window[2]*window[3],
+                             bytes_read=os.path.getsize(src.GetDescription())):
+        if gdal.Translate(output_cropped, src, format="GTiff", srcWin=window) is None:
+            return 2
+
+        if cutline is not None:
+            output_masked = os.path.join(img_destination, str(img_name) + ".TIF")
+            if gdal.Warp(output_masked, src, format="GTiff", cutlineDSName=cutline, cropToCutline=True) is None:
+                return 3
+
+    return 0
+
+
+def crop_images(img_source, img_destination, xmin, ymin, xmax, ymax, mission="sentinel2", mask=MASK_FILE, workers=1):
     band_list = BANDS["Sentinel"]
     if mission=="landsat8":
         band_list = BANDS["Landsat8"]
@@ -36,60 +156,100 @@ def crop_images(img_source, img_destination, xmin, ymin, xmax, ymax, mission="se
         band_list = BANDS["Landsat7"]
     if img_source is None:
         log("ERROR: No image source")
-        return 1
-    else:
-        if img_destination is None:
-            img_destination = os.path.dirname(os.path.realpath(__file__))
-        os.makedirs(img_destination, exist_ok=True)
-        os.makedirs(img_destination + "_cropped", exist_ok=True)
+        return {}
 
-        for image in glob.glob(os.path.join(img_source, "*")):
-            try:
-                img_names = [x for x in band_list if x in image]
-                img_name = max(img_names, key=len)
-                img_name = int(''.join(c for c in img_name if c.isdigit()))
-            except ValueError:
-                img_name = None
+    if img_destination is None:
+        img_destination = os.path.dirname(os.path.realpath(__file__))
+    os.makedirs(img_destination, exist_ok=True)
+    os.makedirs(img_destination + "_cropped", exist_ok=True)
+
+    cutline = load_cutline(mask) if mask is not None else None
+    if mask is not None and cutline is None:
+        # A requested mask that cannot be read fails every band instead of skipping the masked outputs
+        codes = {img_name: 3 for img_name, image in band_images(img_source, band_list)}
+        for img_name in sorted(codes):
+            log("ERROR: Band {}: {}".format(img_name, CROP_ERRORS[3]))
+        return codes
+
+    # No .aux.xml side files, so there is nothing to clean up after each band
+    pam_enabled = gdal.GetConfigOption("GDAL_PAM_ENABLED")
+    gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
+
+    codes = {}
+    jobs = {}
+    windows = {}
+    try:
+        with profile_utils.stage("crop_images", img_source=img_source) as record:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for img_name, image in band_images(img_source, band_list):
+                    src = gdal.Open(image, gdal.GA_ReadOnly)
+                    if src is None:
+                        codes[img_name] = 1
+                        continue
+                    geotransform = src.GetGeoTransform()
+                    if geotransform not in windows:
+                        windows[geotransform] = pixel_window(geotransform, xmin, ymin, xmax, ymax)
+                    log("Converting image {}".format(image))
+                    jobs[img_name] = pool.submit(crop_band, src, img_name, img_destination, windows[geotransform],
+                                                 cutline)
+
+                for img_name, job in jobs.items():
+                    codes[img_name] = job.result()
+            record["bands"] = len(jobs)
+    finally:
+        # Restored even when a band raises, so the rest of the process keeps its PAM setting
+        if cutline is not None:
+            gdal.Unlink(cutline)
+        gdal.SetConfigOption("GDAL_PAM_ENABLED", pam_enabled)
+
+    for img_name, code in sorted(codes.items()):
+        if code != 0:
+            log("ERROR: Band {}: {}".format(img_name, CROP_ERRORS[code]))
 
-            if img_name is not None:
-                log("Converting image {}".format(image))
-                options = "-projwin {} {} {} {} -of GTIFF ".format(xmin, ymin, xmax, ymax)
-                output_cropped = os.path.join(img_destination + "_cropped", str(img_name) + ".TIF")
-                cmd = "gdal_translate {} {} {}".format(options, image, output_cropped)
-                os.system(cmd)
+    return codes
 
-                xml_files = os.listdir(img_destination)
-                for item in xml_files:
-                    if item.endswith(".xml"):
-                        os.remove(os.path.join(img_destination, item))
 
-                output_masked = os.path.join(img_destination, str(img_name) + ".TIF")
-                cmd = "gdalwarp {} {} -cutline mask.gpkg -crop_to_cutline".format(image, output_masked)
-                os.system(cmd)
+def read_band(source_image, mission="sentinel2", dtype=numpy.float32):
+    src = gdal.Open(source_image, gdal.GA_ReadOnly)
+    if src is None:
+        log("ERROR: Could not open {}".format(source_image))
+        return None, None
 
-                xml_files = os.listdir(img_destination + "_cropped")
-                for item in xml_files:
-                    if item.endswith(".xml"):
-                        os.remove(os.path.join(img_destination + "_cropped", item))
+    band = src.GetRasterBand(1)
+    with profile_utils.stage("gdal_read", image=source_image) as record:
+        data = band.ReadAsArray()
+        record.update(pixels=data.size, bytes_read=data.nbytes)
 
-        return 0
+    with profile_utils.stage("normalize", image=source_image, pixels=data.size):
+        img = data.astype(dtype)
+        img /= mission_kmax(mission)*DEPTH_DIVISOR.get(data.dtype.name, 1)
+        clear_nodata(img, data, band.GetNoDataValue())
+    return img, georeference(src)
+
+
+def clear_nodata(img, data, nodata):
+    # No data is 0 in the normalized bands, whatever value the raster uses for it
+    if nodata is not None and nodata != 0:
+        img[data == nodata] = 0
+
+
+def georeference(src):
+    return {
+        "geotransform": src.GetGeoTransform(),
+        "projection": src.GetProjection(),
+        "size": (src.RasterXSize, src.RasterYSize)
+    }
 
 
 def normalize_image(source_image, min_value=0, max_value=1, mission="sentinel2"):
-    img = cv2.imread("{}".format(source_image))
-    if mission == "sentinel2":
-        kmax = 70
-    elif mission == "landsat8":
-        kmax = 220
-    else:
-        kmax = 255
+    return read_band(source_image, mission=mission)[0]
 
-    img = asarray(img, dtype=numpy.float64)/kmax
-    return img
 
+def mission_kmax(mission="sentinel2"):
+    return KMAX.get(mission, KMAX["landsat7"])
 
-def create_raster(source_dir, mission='sentinel2'):
-    IMAGES = {}
+
+def band_paths(source_dir):
     image_paths = glob.glob(os.path.join(source_dir, "*"))
     image_extension = image_paths[0].split(".")[-1]
 
@@ -97,37 +257,234 @@ def create_raster(source_dir, mission='sentinel2'):
     image_names = [int(x.replace(".", "")) for x in image_names]
     image_names.sort()
 
-    for image_name in image_names:
-        band = image_name
-        image_path = os.path.join(source_dir, "{}.{}".format(image_name, image_extension))
-        image_data = normalize_image(image_path, mission=mission)
-        IMAGES[band] = image_data
-        IMAGES["coordinates"] = img_corners(img=image_path)
+    return [(x, os.path.join(source_dir, "{}.{}".format(x, image_extension))) for x in image_names]
+
+
+def create_raster(source_dir, mission='sentinel2'):
+    IMAGES = {}
+    with profile_utils.stage("create_raster", source_dir=source_dir) as record:
+        for band, image_path in band_paths(source_dir):
+            image_data, georef = read_band(image_path, mission=mission)
+            if image_data is None:
+                raise OSError("Could not open {}".format(image_path))
+            IMAGES[band] = image_data
+            if "georeference" not in IMAGES:
+                IMAGES["georeference"] = georef
+                IMAGES["coordinates"] = georef_corners(georef)
+        record.update(bands=len(IMAGES) - 2, pixels=georef["size"][0]*georef["size"][1])
 
     return IMAGES
 
-def utm32_latlon(pointX, pointY):
-    inputEPSG = 32632
-    outputEPSG = 4326
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.AddPoint(pointX, pointY)
-    inSpatialRef = osr.SpatialReference()
-    inSpatialRef.ImportFromEPSG(inputEPSG)
-    outSpatialRef = osr.SpatialReference()
-    outSpatialRef.ImportFromEPSG(outputEPSG)
-    coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
-    point.Transform(coordTransform)
 
-    return (point.GetX(), point.GetY())
+def update_file_hash(digest, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest
+
+
+def file_hash(path):
+    return update_file_hash(hashlib.sha256(), path).hexdigest()
+
+
+def band_stats(source_dir):
+    # (band, path, size, mtime) of every band file; a change of any of them means the scene changed
+    stats = []
+    for band, image_path in band_paths(source_dir):
+        stat = os.stat(image_path)
+        stats.append((band, image_path, stat.st_size, stat.st_mtime_ns))
+    return stats
+
+
+def stack_key(source_dir, mission="sentinel2"):
+    digest = hashlib.sha256("{}:{}".format(mission, mission_kmax(mission)).encode())
+    for band, image_path, size, mtime in band_stats(source_dir):
+        digest.update("{}:{}:{}:{}".format(band, size, mtime, file_hash(image_path)).encode())
+    return digest.hexdigest()
+
+
+def write_stack(source_dir, path, mission="sentinel2"):
+    # Bands are decoded one at a time straight into the mapped file, on the grid of the first band
+    paths = band_paths(source_dir)
+    first, georef = read_band(paths[0][1], mission=mission)
+    rows, cols = first.shape
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    stack = numpy.lib.format.open_memmap(tmp, mode="w+", dtype=numpy.float32, shape=(rows, cols, len(paths)))
+    stack[:, :, 0] = first
+    for n, (band, image_path) in enumerate(paths[1:], 1):
+        stack[:, :, n] = read_band(image_path, mission=mission)[0][:rows, :cols]
+    stack.flush()
+    del stack
+
+    # The header goes in place before the stack, so a stack on disk always has its header
+    header = {"bands": [x[0] for x in paths], "mission": mission, "kmax": mission_kmax(mission), "georeference": georef}
+    header_tmp = "{}.{}.tmp".format(stack_header(path), os.getpid())
+    with open(header_tmp, "w") as f:
+        json.dump(header, f)
+    os.replace(header_tmp, stack_header(path))
+    os.replace(tmp, path)
+
+
+def stack_header(path):
+    return path[:-len(".npy")] + ".json"
+
+
+def remove_stale_stacks(cache_dir, path):
+    # Each stack is a full copy of the scene, so only the one just written is kept
+    for stale in glob.glob(os.path.join(cache_dir, "stack_*.npy")) + glob.glob(os.path.join(cache_dir, "stack_*.json")):
+        if stale not in (path, stack_header(path)):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+def cached_stack(source_dir, mission="sentinel2", cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(source_dir, STACK_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    path = os.path.join(cache_dir, "stack_{}.npy".format(stack_key(source_dir, mission=mission)))
+    with profile_utils.stage("cached_stack", source_dir=source_dir) as record:
+        cached = os.path.exists(path) and os.path.exists(stack_header(path))
+        if not cached:
+            write_stack(source_dir, path, mission=mission)
+            remove_stale_stacks(cache_dir, path)
+        record["cached"] = cached
+
+        with open(stack_header(path)) as f:
+            header = json.load(f)
+        stack = numpy.load(path, mmap_mode="r")
+
+    return stack, header
+
+
+def open_bands(source_dir):
+    bands = []
+    datasets = []
+    for band, image_path in band_paths(source_dir):
+        src = gdal.Open(image_path, gdal.GA_ReadOnly)
+        if src is None:
+            log("ERROR: Could not open {}".format(image_path))
+            return None, None
+        bands.append(band)
+        datasets.append(src)
+
+    return bands, datasets
+
+
+def iter_windows(xsize, ysize, block_size=BLOCK_SIZE):
+    for yoff in range(0, ysize, block_size):
+        for xoff in range(0, xsize, block_size):
+            yield xoff, yoff, min(block_size, xsize - xoff), min(block_size, ysize - yoff)
+
+
+def read_window(datasets, window, mission="sentinel2"):
+    # Every band is read on the pixel grid of the first one, like create_raster does.
+    xoff, yoff, xsize, ysize = window
+    kmax = mission_kmax(mission)
+    stack = numpy.empty([ysize, xsize, len(datasets)], dtype=numpy.float32)
+    with profile_utils.stage("read_window", window=window, pixels=xsize*ysize) as record:
+        bytes_read = 0
+        for n, src in enumerate(datasets):
+            band = src.GetRasterBand(1)
+            data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            stack[:, :, n] = data
+            stack[:, :, n] /= kmax*DEPTH_DIVISOR.get(data.dtype.name, 1)
+            clear_nodata(stack[:, :, n], data, band.GetNoDataValue())
+            bytes_read += data.nbytes
+        record["bytes_read"] = bytes_read
+
+    return stack
+
+
+def create_label_raster(output, georef, nodata=0, palette=None):
+    # Blocks are written into a tiled staging GeoTIFF; close_label_raster copies it into the cloud optimized output
+    driver = gdal.GetDriverByName("GTiff")
+    dst = driver.Create("{}.{}.tmp".format(output, os.getpid()), georef["size"][0], georef["size"][1], 1,
+                        gdal.GDT_Byte, options=["TILED=YES", "COMPRESS=DEFLATE"])
+    dst.SetGeoTransform(georef["geotransform"])
+    dst.SetProjection(georef["projection"])
+    dst_band = dst.GetRasterBand(1)
+    dst_band.SetNoDataValue(nodata)
+    if palette is not None:
+        color_table = gdal.ColorTable()
+        for value, color in enumerate(palette):
+            color_table.SetColorEntry(value, tuple(int(x) for x in color) + (255,))
+        dst_band.SetRasterColorTable(color_table)
+        dst_band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    return dst
+
+
+def close_label_raster(dst, output):
+    # The COG driver lays out the tiles and the overviews (NEAREST, so they only hold class values) for
+    # range requests, which a GeoTIFF with overviews added after its data does not
+    dst.FlushCache()
+    staging = dst.GetDescription()
+    cog = gdal.GetDriverByName("COG").CreateCopy(output, dst, options=[
+        "COMPRESS=DEFLATE", "BLOCKSIZE={}".format(BLOCK_SIZE), "OVERVIEW_RESAMPLING=NEAREST"])
+    if cog is None:
+        log("ERROR: Could not write {}".format(output))
+    cog = None
+    dst = None
+    gdal.Unlink(staging)
+
+
+def write_label_raster(labels, output, georef, nodata=0, palette=None):
+    dst = create_label_raster(output, georef, nodata=nodata, palette=palette)
+    dst.GetRasterBand(1).WriteArray(labels)
+    close_label_raster(dst, output)
+
+
+def spatial_reference(crs):
+    srs = osr.SpatialReference()
+    if isinstance(crs, int):
+        srs.ImportFromEPSG(crs)
+    else:
+        srs.SetFromUserInput(crs)
+    # (x, y) is (easting, northing) or (longitude, latitude), whatever the GDAL version
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def coordinate_transform(source, target=LATLON_EPSG):
+    # OSR transformations are expensive to build and not thread safe, so each thread keeps its own
+    cache = getattr(_TRANSFORMS, "cache", None)
+    if cache is None:
+        cache = _TRANSFORMS.cache = {}
+    key = (source, target)
+    if key not in cache:
+        cache[key] = osr.CoordinateTransformation(spatial_reference(source), spatial_reference(target))
+    return cache[key]
+
+
+def raster_crs(georef):
+    return georef["projection"] or DEFAULT_EPSG
+
+
+def transform_points(points, source=DEFAULT_EPSG, target=LATLON_EPSG):
+    # points is an array of (x, y) rows, transformed in a single call
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    transformed = coordinate_transform(source, target).TransformPoints(points.tolist())
+    return numpy.array(transformed, dtype=numpy.float64)[:, :2]
+
+
+def utm32_latlon(pointX, pointY):
+    return tuple(transform_points([(pointX, pointY)])[0])
 
 
 def img_corners(img):
     src = gdal.Open(img, gdal.GA_ReadOnly)
-    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
-    lrx = ulx + (src.RasterXSize * xres)
-    lry = uly + (src.RasterYSize * yres)
+    return georef_corners(georeference(src))
+
+
+def georef_corners(georef, target=LATLON_EPSG):
+    ulx, xres, xskew, uly, yskew, yres = georef["geotransform"]
+    lrx = ulx + (georef["size"][0] * xres)
+    lry = uly + (georef["size"][1] * yres)
 
-    return [utm32_latlon(lrx, lry), utm32_latlon(ulx, uly)]
+    corners = transform_points([(lrx, lry), (ulx, uly)], source=raster_crs(georef), target=target)
+    return [tuple(x) for x in corners]
 
 
 #crop_images(img_source="/Users/areitu/Downloads/LC08_L2SP_007013_20170814_20200903_02_T1",
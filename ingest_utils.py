@@ -0,0 +1,157 @@
+"""
+This module contains the ingest step that turns the band images of a scene
+into one array for repeated classification runs.
+Here you will find functions that copy the raw band values into a single
+band-interleaved-by-pixel .npy file with a JSON header next to it, build
+decimated overview levels of it and classify a scene straight from the
+memory-mapped arrays, at full resolution or as a quick preview.
+"""
+
+import os
+import json
+import numpy
+from osgeo import gdal_array
+import data_utils
+import image_utils
+import classify_utils
+import profile_utils
+
+
+# Inside the scene directory, hidden so band_paths does not take it for a band
+INGEST_DIR = ".ingest"
+
+
+def ingest_dir(source_dir):
+    return os.path.join(source_dir, INGEST_DIR)
+
+
+def level_path(scene_dir, factor=1):
+    return os.path.join(scene_dir, "bands.npy" if factor == 1 else "overview_{}.npy".format(factor))
+
+
+def read_header(scene_dir):
+    path = os.path.join(scene_dir, "bands.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_overviews(scene_dir, data, factors=image_utils.OVERVIEW_FACTORS, block_size=image_utils.BLOCK_SIZE):
+    # Nearest neighbour decimation keeps raw values (and no data) intact; rows are copied one strip at a time
+    rows, cols = data.shape[:2]
+    levels = [x for x in factors if rows >= x and cols >= x]
+    for factor in levels:
+        shape = (-(-rows//factor), -(-cols//factor), data.shape[2])
+        overview = numpy.lib.format.open_memmap(level_path(scene_dir, factor), mode="w+", dtype=data.dtype,
+                                                shape=shape)
+        for yoff in range(0, shape[0], block_size):
+            overview[yoff:yoff + block_size] = data[yoff*factor:(yoff + block_size)*factor:factor, ::factor]
+        overview.flush()
+        del overview
+    return levels
+
+
+def ingest_scene(source_dir, scene_dir=None, block_size=image_utils.BLOCK_SIZE, force=False):
+    if scene_dir is None:
+        scene_dir = ingest_dir(source_dir)
+    # A scene is ingested again as soon as one of its band files changes; lists, to compare with the JSON header
+    sources = [[band, size, mtime] for band, image_path, size, mtime in image_utils.band_stats(source_dir)]
+    header = read_header(scene_dir)
+    if not force and header is not None and header["sources"] == sources:
+        return header
+
+    bands, datasets = image_utils.open_bands(source_dir)
+    if datasets is None:
+        return None
+    os.makedirs(scene_dir, exist_ok=True)
+
+    # Every band is copied on the grid of the first one, like read_window does
+    georef = image_utils.georeference(datasets[0])
+    xsize, ysize = georef["size"]
+    dtypes = [numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(x.GetRasterBand(1).DataType)) for x in datasets]
+    path = level_path(scene_dir)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with profile_utils.stage("ingest_scene", source_dir=source_dir, bands=len(bands), pixels=xsize*ysize) as record:
+        data = numpy.lib.format.open_memmap(tmp, mode="w+", dtype=numpy.result_type(*dtypes),
+                                            shape=(ysize, xsize, len(bands)))
+        for xoff, yoff, width, height in image_utils.iter_windows(xsize, ysize, block_size):
+            for n, src in enumerate(datasets):
+                block = src.GetRasterBand(1).ReadAsArray(xoff, yoff, width, height)
+                data[yoff:yoff + height, xoff:xoff + width, n] = block
+        data.flush()
+        record["bytes_written"] = data.nbytes
+        levels = write_overviews(scene_dir, data, block_size=block_size)
+        del data
+        os.replace(tmp, path)
+
+    header = {
+        "sources": sources,
+        "bands": bands,
+        "depth_divisors": [image_utils.DEPTH_DIVISOR.get(x.name, 1) for x in dtypes],
+        "nodata": [x.GetRasterBand(1).GetNoDataValue() for x in datasets],
+        "georeference": georef,
+        "overviews": levels
+    }
+    with open(os.path.join(scene_dir, "bands.json"), "w") as f:
+        json.dump(header, f)
+    return header
+
+
+def open_scene(scene_dir, factor=1):
+    # The level is mapped read-only; windows of it are views of the file, not copies
+    header = read_header(scene_dir)
+    if factor != 1 and factor not in header["overviews"]:
+        raise ValueError("No overview with factor {}, available: {}".format(factor, header["overviews"]))
+    return numpy.load(level_path(scene_dir, factor), mmap_mode="r"), header
+
+
+def level_georeference(georef, shape, factor=1):
+    # An overview pixel holds the top left source pixel of its cell, so the grid is shifted by half a cell
+    # minus half a source pixel to put every overview pixel centre on the centre of the pixel it sampled
+    ulx, xres, xskew, uly, yskew, yres = georef["geotransform"]
+    shift = 0.5 - factor/2
+    ulx += shift*(xres + xskew)
+    uly += shift*(yskew + yres)
+    return {
+        "geotransform": (ulx, xres*factor, xskew*factor, uly, yskew*factor, yres*factor),
+        "projection": georef["projection"],
+        "size": (shape[1], shape[0])
+    }
+
+
+def normalize_window(data, header, mission="sentinel2"):
+    stack = data.astype(numpy.float32)
+    stack /= image_utils.mission_kmax(mission)*numpy.array(header["depth_divisors"], dtype=numpy.float32)
+    for n, nodata in enumerate(header["nodata"]):
+        image_utils.clear_nodata(stack[:, :, n], data[:, :, n], nodata)
+    return stack
+
+
+def classify_ingested(source_dir, output=None, mission="sentinel2", factor=1, backend=classify_utils.DEFAULT_BACKEND,
+                      precision=classify_utils.DEFAULT_PRECISION, mask=None, block_size=image_utils.BLOCK_SIZE,
+                      scene_dir=None, hcrf_file=data_utils.HCRF_FILE):
+    # A factor above 1 classifies one of the overview levels, a quick low resolution preview of the scene
+    if scene_dir is None:
+        scene_dir = ingest_dir(source_dir)
+    if ingest_scene(source_dir, scene_dir, block_size=block_size) is None:
+        return None
+    data, header = open_scene(scene_dir, factor=factor)
+    georef = level_georeference(header["georeference"], data.shape, factor=factor)
+    classifier = classify_utils.create_classifier(header["bands"], mission=mission, backend=backend,
+                                                  hcrf_file=hcrf_file)
+    cutline = image_utils.open_cutline(mask) if mask is not None else None
+
+    # Whole rows are contiguous in the file, so every strip is read from a single range of pages
+    labels = numpy.empty(data.shape[:2], dtype=numpy.uint8)
+    with profile_utils.stage("classify_ingested", source_dir=source_dir, factor=factor, pixels=labels.size):
+        for yoff in range(0, data.shape[0], block_size):
+            window = (0, yoff, data.shape[1], min(block_size, data.shape[0] - yoff))
+            stack = normalize_window(data[yoff:yoff + block_size], header, mission=mission)
+            valid = classify_utils.valid_pixels(stack, georef, cutline, window=window)
+            labels[yoff:yoff + block_size] = classify_utils.classify_valid(stack, classifier, valid, precision=precision)
+
+    if output is not None:
+        image_utils.write_label_raster(labels, output, georef, nodata=classify_utils.NODATA_LABEL,
+                                       palette=classify_utils.label_palette())
+    return labels
@@ -1,75 +1,59 @@
 """
 This module applies a minimum distance classification on the pre-processed and cropped images.
 This should output a classified map of the Corbassiere glacier.
+It is also the command-line entry point, with the classify, ingest, crop,
+build-centroids, batch and changes subcommands. PIL and matplotlib are only imported by the code that
+draws the maps, so counts-only runs start quickly.
 """
 
-from PIL import Image
+import os
+import sys
+import json
+import argparse
 import numpy
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
 import image_utils
 import data_utils
-import os
+import classify_utils
+import batch_utils
+import change_utils
+import ingest_utils
+import profile_utils
 
 
-def minimum_distance_classification(source_dir, output="Classification.png", title="Glacier Classification", mission="sentinel2"):
-    data_utils.create_dataset(file=data_utils.HCRF_FILE, savefig=True)
+def minimum_distance_classification(source_dir, output="Classification.png", title="Glacier Classification", mission="sentinel2",
+                                    savefig=False, figure=True, show=False, mask=None, hcrf_file=data_utils.HCRF_FILE,
+                                    backend=classify_utils.DEFAULT_BACKEND, precision=classify_utils.DEFAULT_PRECISION):
+    data_utils.load_centroids(file=hcrf_file, savefig=savefig)
     IMAGES = image_utils.create_raster(source_dir, mission=mission)
-    bands = list(IMAGES.keys())
-    bands.remove("coordinates")
-    coordinates = IMAGES["coordinates"]
-    nr_pixels = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-
-    if mission == "landsat8":
-        k = 1
-        CI = k*numpy.array([data_utils.CI_L8[x] for x in bands])
-        SN = k*numpy.array([data_utils.SN_L8[x] for x in bands])
-        LA = k*numpy.array([data_utils.LA_L8[x] for x in bands])
-        HA = k*numpy.array([data_utils.HA_L8[x] for x in bands])
-        CC = k*numpy.array([data_utils.CC_L8[x] for x in bands])
-    elif mission == "landsat7":
-        k = 1.2
-        CI = k*numpy.array([data_utils.CI_L7[x] for x in bands])
-        SN = k*numpy.array([data_utils.SN_L7[x] for x in bands])
-        LA = k*numpy.array([data_utils.LA_L7[x] for x in bands])
-        HA = k*numpy.array([data_utils.HA_L7[x] for x in bands])
-        CC = k*numpy.array([data_utils.CC_L7[x] for x in bands])
-    else:
-        k = 0.5
-        CI = k*numpy.array([data_utils.CI[x] for x in bands])
-        SN = k*numpy.array([data_utils.SN[x] for x in bands])
-        LA = k*numpy.array([data_utils.LA[x] for x in bands])
-        HA = k*numpy.array([data_utils.HA[x] for x in bands])
-        CC = k*numpy.array([data_utils.CC[x] for x in bands])
-
-    image_shape = numpy.shape(list(IMAGES.items())[0][1])
-    MAP_DATA = numpy.zeros([image_shape[0], image_shape[1], 3], dtype=numpy.uint8)
-    MAP_DATA.fill(255)
-    for i in range(0, image_shape[0]):
-        for j in range(0, image_shape[1]):
-            p = []
-            for band in bands:
-                image = IMAGES[band]
-                p.append(image[i, j])
-
-            p = numpy.array(p)
-            if p.ndim > 1:
-                p = p[:, 1]
-            if numpy.all(p==0):
-                MAP_DATA[i, j] = data_utils.COLORS[6]
-            else:
-                d_CI = numpy.linalg.norm(p - numpy.array(CI))
-                d_SN = numpy.linalg.norm(p - numpy.array(SN))
-                d_LA = numpy.linalg.norm(p - numpy.array(LA))
-                d_HA = numpy.linalg.norm(p - numpy.array(HA))
-                d_CC = numpy.linalg.norm(p - numpy.array(CC))
-                distances = [d_CI, d_SN, d_LA, d_HA, d_CC]
-
-                MAP_DATA[i, j] = data_utils.COLORS[distances.index(min(distances)) + 1]
-                nr_pixels[distances.index(min(distances)) + 1] += 1
-
-    img = Image.fromarray(MAP_DATA, 'RGB')
-    img.save(output + ".png")
+
+    labels = classify_utils.classify_raster(IMAGES, mission=mission, precision=precision, mask=mask, backend=backend)
+    MAP_DATA = classify_utils.label_colors(labels)
+    nr_pixels = classify_utils.count_pixels(labels)
+
+    write_classification(labels, MAP_DATA, IMAGES["georeference"], output=output)
+    if figure:
+        plot_classification(MAP_DATA, nr_pixels, IMAGES["coordinates"], output=output, title=title, show=show)
+    return labels
+
+
+def write_classification(labels, MAP_DATA, georef, output="Classification.png"):
+    from PIL import Image
+
+    image_utils.write_label_raster(labels, output + ".tif", georef, nodata=classify_utils.NODATA_LABEL,
+                                   palette=classify_utils.label_palette())
+    Image.fromarray(MAP_DATA, 'RGB').save(output + ".png", compress_level=1)
+
+
+def coordinate_ticks(start, stop, size, nbins):
+    ticks = numpy.linspace(0, size - 1, nbins + 1)
+    labels = numpy.around(numpy.linspace(start, stop, nbins + 1), 2)
+    return ticks, labels
+
+
+def plot_classification(MAP_DATA, nr_pixels, coordinates, output="Classification.png", title="Glacier Classification",
+                        show=False):
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
 
     custom_lines = [Line2D([0], [0], color="lightskyblue", lw=4),
                     Line2D([0], [0], color="white", lw=4),
@@ -83,43 +67,173 @@ def minimum_distance_classification(source_dir, output="Classification.png", tit
                              'Low Algae ({} pixels)'.format(nr_pixels[3]),
                              'High Algae ({} pixels)'.format(nr_pixels[4]),
                              'Cryoconite ({} pixels)'.format(nr_pixels[5])], bbox_to_anchor=(2.3, 1), facecolor="lightgrey")
-    plt.imshow(img)
+    plt.imshow(MAP_DATA)
     plt.title(title)
 
     plt.xlabel("Longitude")
     plt.ylabel("Latitude")
 
-    Xcoord = numpy.linspace(coordinates[0][0], coordinates[1][0], img.size[0])
-    Xcoord = numpy.around(Xcoord, 2)
-    plt.xticks(range(0, img.size[0]), Xcoord)
-    plt.locator_params(axis='x', nbins=4)
-
-    Ycoord = numpy.linspace(coordinates[0][1], coordinates[1][1], img.size[1])
-    Ycoord = numpy.around(Ycoord, 2)
-    plt.yticks(range(0, img.size[1]), Ycoord)
-    plt.locator_params(axis='y', nbins=6)
+    # A handful of ticks instead of one per pixel column and row. coordinates is [lower right, upper left],
+    # and column 0 is the western edge while row 0 is the northern one.
+    rows, cols = MAP_DATA.shape[:2]
+    plt.xticks(*coordinate_ticks(coordinates[1][0], coordinates[0][0], cols, nbins=4))
+    plt.yticks(*coordinate_ticks(coordinates[1][1], coordinates[0][1], rows, nbins=6))
 
     plt.savefig(os.path.join(os.getcwd(), output + "_figure.png"))
-    plt.show()
-
+    if show:
+        plt.show()
+    plt.close(fig)
 
-def main():
-    #minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Landsat-7", "Greenland_cropped"),
-    #                                output="Greenland_Landsat7", mission="landsat7")
-    minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Landsat-8", "Greenland_cropped"),
-                                    output="Greenland_Landsat8", mission="landsat8")
-    minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Sentinel-2", "Greenland_cropped"),
-                                   output="Greenland_Sentinel2", mission="sentinel2")
-    #minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Landsat-7", "2014"),
-    #                               output="Corbassiere_Landsat7", mission="landsat7", title="L7 2014")
-    #minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Landsat-8", "2014"),
-    #                                output="Corbassiere_Landsat8", mission="landsat8", title="L8 2014 *TRUE")
 
-    #minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Sentinel-2", "2015"),
-    #                                output="Corbassiere_Sentinel2", mission="sentinel2", title="S2 2015")
-    #minimum_distance_classification(source_dir=os.path.join(os.getcwd(), "Landsat-8", "2014"),
-    #                                output="Corbassiere_Landsat8", mission="landsat8", title="L8 2014")
+def count_classes(source_dir, mission="sentinel2", precision=classify_utils.DEFAULT_PRECISION, mask=None,
+                  hcrf_file=data_utils.HCRF_FILE, backend=classify_utils.DEFAULT_BACKEND):
+    data_utils.load_centroids(file=hcrf_file)
+    IMAGES = image_utils.create_raster(source_dir, mission=mission)
+    labels = classify_utils.classify_raster(IMAGES, mission=mission, precision=precision, mask=mask, backend=backend)
+    return classify_utils.count_pixels(labels)
+
+
+def run_classify(args):
+    if args.counts_only:
+        nr_pixels = count_classes(args.source_dir, mission=args.mission, precision=args.precision, mask=args.mask,
+                                  hcrf_file=args.training_data, backend=args.backend)
+    elif args.overview is not None:
+        data_utils.load_centroids(file=args.training_data)
+        try:
+            labels = ingest_utils.classify_ingested(args.source_dir, args.output + ".tif", mission=args.mission,
+                                                    factor=args.overview, backend=args.backend,
+                                                    precision=args.precision, mask=args.mask,
+                                                    block_size=args.block_size)
+        except ValueError as error:
+            image_utils.log("ERROR: {}".format(error))
+            return 1
+        if labels is None:
+            image_utils.log("ERROR: Could not open the bands of {}".format(args.source_dir))
+            return 1
+        nr_pixels = classify_utils.count_pixels(labels)
+    elif args.tiled:
+        data_utils.load_centroids(file=args.training_data)
+        nr_pixels = classify_utils.classify_tiled(args.source_dir, args.output + ".tif", mission=args.mission,
+                                                  block_size=args.block_size, workers=args.workers,
+                                                  precision=args.precision, mask=args.mask, backend=args.backend)
+        if nr_pixels is None:
+            image_utils.log("ERROR: Could not open the bands of {}".format(args.source_dir))
+            return 1
+    else:
+        labels = minimum_distance_classification(args.source_dir, output=args.output, title=args.title,
+                                                 mission=args.mission, figure=args.figure, mask=args.mask,
+                                                 hcrf_file=args.training_data, backend=args.backend,
+                                                 precision=args.precision)
+        nr_pixels = classify_utils.count_pixels(labels)
+
+    print(json.dumps({classify_utils.CLASSES[x - 1]: y for x, y in nr_pixels.items()}))
+    return 0
+
+
+def run_ingest(args):
+    header = ingest_utils.ingest_scene(args.source_dir, block_size=args.block_size, force=args.force)
+    if header is None:
+        return 1
+    print(json.dumps({"bands": header["bands"], "overviews": header["overviews"]}))
+    return 0
+
+
+def run_crop(args):
+    xmin, ymin, xmax, ymax = args.projwin
+    codes = image_utils.crop_images(args.img_source, args.img_destination, xmin, ymin, xmax, ymax,
+                                    mission=args.mission, mask=args.mask, workers=args.workers)
+    print(json.dumps(codes))
+    return int(not codes or any(codes.values()))
+
+
+def run_build_centroids(args):
+    data_utils.load_centroids(file=args.training_data, cache=args.cache, savefig=args.plot, rebuild=True)
+    return 0
+
+
+def run_batch(args):
+    batch_utils.run_batch(args.archive, database=args.results, hcrf_file=args.training_data, workers=args.workers,
+                          force=args.force, backend=args.backend)
+    return 0
+
+
+def run_changes(args):
+    matrices = change_utils.detect_changes(args.label_rasters, output=args.output, table=args.table,
+                                           block_size=args.block_size)
+    if matrices is None:
+        return 1
+    print(json.dumps({"{} -> {}".format(*x): int(y.sum() - y.trace()) for x, y in matrices.items()}))
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Glacier surface classification.")
+    parser.add_argument("--profile", metavar="PATH", help="write per-stage timings to this JSON lines file")
+    parser.add_argument("--training-data", default=data_utils.HCRF_FILE, help="path to TrainingData.csv")
+    missions = ["sentinel2", "landsat8", "landsat7"]
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    classify = subparsers.add_parser("classify", help="classify one scene")
+    classify.add_argument("source_dir", help="directory containing the band images")
+    classify.add_argument("--mission", default="sentinel2", choices=missions)
+    classify.add_argument("--output", default="Classification", help="output name, without extension")
+    classify.add_argument("--title", default="Glacier Classification")
+    classify.add_argument("--mask", help="cutline used to skip the pixels outside the glacier")
+    classify.add_argument("--precision", default=classify_utils.DEFAULT_PRECISION, choices=classify_utils.PRECISIONS)
+    classify.add_argument("--backend", default=classify_utils.DEFAULT_BACKEND, choices=list(classify_utils.BACKENDS))
+    classify.add_argument("--counts-only", action="store_true", help="only print the class pixel counts")
+    classify.add_argument("--tiled", action="store_true", help="stream blocks into a GeoTIFF")
+    classify.add_argument("--overview", type=int, metavar="FACTOR",
+                          help="classify the ingested scene, reduced by FACTOR (1 for full resolution)")
+    classify.add_argument("--block-size", type=int, default=image_utils.BLOCK_SIZE)
+    classify.add_argument("--workers", type=int, default=1)
+    classify.add_argument("--figure", action="store_true", help="also render the map figure")
+    classify.set_defaults(func=run_classify)
+
+    ingest = subparsers.add_parser("ingest", help="copy the bands of a scene into one memory-mappable array")
+    ingest.add_argument("source_dir", help="directory containing the band images")
+    ingest.add_argument("--block-size", type=int, default=image_utils.BLOCK_SIZE)
+    ingest.add_argument("--force", action="store_true", help="ingest the scene again")
+    ingest.set_defaults(func=run_ingest)
+
+    crop = subparsers.add_parser("crop", help="crop and mask the bands of a scene")
+    crop.add_argument("img_source")
+    crop.add_argument("img_destination")
+    crop.add_argument("--projwin", type=float, nargs=4, required=True, metavar=("XMIN", "YMIN", "XMAX", "YMAX"))
+    crop.add_argument("--mission", default="sentinel2", choices=missions)
+    crop.add_argument("--mask", default=image_utils.MASK_FILE)
+    crop.add_argument("--workers", type=int, default=1)
+    crop.set_defaults(func=run_crop)
+
+    build = subparsers.add_parser("build-centroids", help="rebuild the centroid cache from the training data")
+    build.add_argument("--cache", help="path of the cache (next to the training data by default)")
+    build.add_argument("--plot", action="store_true", help="also plot the training spectra")
+    build.set_defaults(func=run_build_centroids)
+
+    batch = subparsers.add_parser("batch", help="classify every new or changed scene of an archive")
+    batch.add_argument("archive", nargs="?", default=".")
+    batch.add_argument("--results", default=batch_utils.RESULTS_FILE)
+    batch.add_argument("--workers", type=int)
+    batch.add_argument("--backend", default=classify_utils.DEFAULT_BACKEND, choices=list(classify_utils.BACKENDS))
+    batch.add_argument("--force", action="store_true", help="classify every scene again")
+    batch.set_defaults(func=run_batch)
+
+    changes = subparsers.add_parser("changes", help="compare the label rasters of a series of scenes")
+    changes.add_argument("label_rasters", nargs="+", help="label GeoTIFFs on the same grid, oldest first")
+    changes.add_argument("--output", default=change_utils.CHANGE_FILE, help="change GeoTIFF")
+    changes.add_argument("--table", default=change_utils.TRANSITIONS_FILE, help="transition table (CSV)")
+    changes.add_argument("--block-size", type=int, default=image_utils.BLOCK_SIZE)
+    changes.set_defaults(func=run_changes)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.profile:
+        profile_utils.enable(args.profile)
+    return args.func(args)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""
+This module runs the classifier as a long-running local service.
+The class centroids are loaded once at startup and the band stacks of
+recently used scenes are kept in an LRU cache with a memory cap, so an
+on-demand request only pays for the distance step. Requests and responses
+are JSON over HTTP; request_classification is a small client for it.
+"""
+
+import os
+import sys
+import json
+import zlib
+import base64
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy
+import data_utils
+import image_utils
+import classify_utils
+
+
+HOST = "127.0.0.1"
+PORT = 8750
+CACHE_MB = 2048
+
+
+def scene_key(source_dir, mission):
+    # A scene is reloaded as soon as one of its band files changes
+    bands = tuple((band, size, mtime) for band, image_path, size, mtime in image_utils.band_stats(source_dir))
+    return os.path.realpath(source_dir), mission, bands
+
+
+def load_scene(source_dir, mission):
+    IMAGES = image_utils.create_raster(source_dir, mission=mission)
+    bands = classify_utils.raster_bands(IMAGES)
+    stack = classify_utils.stack_bands(IMAGES, bands)
+    return {
+        "stack": stack,
+        "bands": bands,
+        "georeference": IMAGES["georeference"],
+        "nbytes": stack.nbytes
+    }
+
+
+class StackCache:
+    def __init__(self, max_bytes=CACHE_MB*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, source_dir, mission):
+        key = scene_key(source_dir, mission)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        entry = load_scene(source_dir, mission)
+        self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            # Older versions of the same scene are dropped right away
+            for old in [x for x in self.entries if x[:2] == key[:2]]:
+                self.nbytes -= self.entries.pop(old)["nbytes"]
+            if entry["nbytes"] > self.max_bytes:
+                return
+            while self.entries and self.nbytes + entry["nbytes"] > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1]["nbytes"]
+            self.entries[key] = entry
+            self.nbytes += entry["nbytes"]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "scenes": len(self.entries),
+                "mb": self.nbytes/2**20,
+                "max_mb": self.max_bytes/2**20,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def encode_labels(labels):
+    return base64.b64encode(zlib.compress(numpy.ascontiguousarray(labels).tobytes(), 1)).decode("ascii")
+
+
+def decode_labels(data, shape):
+    return numpy.frombuffer(zlib.decompress(base64.b64decode(data)), dtype=numpy.uint8).reshape(shape)
+
+
+def classify_request(cache, request):
+    source_dir = request["source_dir"]
+    mission = request.get("mission", "sentinel2")
+    precision = request.get("precision", classify_utils.DEFAULT_PRECISION)
+    if precision not in classify_utils.PRECISIONS:
+        raise ValueError("Unknown precision {}".format(precision))
+    backend = request.get("backend", classify_utils.DEFAULT_BACKEND)
+    if backend not in classify_utils.BACKENDS:
+        raise ValueError("Unknown backend {}".format(backend))
+
+    entry = cache.get(source_dir, mission)
+    classifier = classify_utils.create_classifier(entry["bands"], mission=mission, backend=backend)
+    cutline = image_utils.open_cutline(request["mask"]) if request.get("mask") else None
+    valid = classify_utils.valid_pixels(entry["stack"], entry["georeference"], cutline)
+    labels = classify_utils.classify_valid(entry["stack"], classifier, valid, precision=precision)
+
+    response = {
+        "source_dir": source_dir,
+        "mission": mission,
+        "shape": list(labels.shape),
+        "nr_pixels": classify_utils.count_pixels(labels)
+    }
+    if request.get("labels", True):
+        response["labels"] = encode_labels(labels)
+    return response
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "cache": self.server.cache.stats()})
+        else:
+            self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            response = classify_request(self.server.cache, request)
+        except (ValueError, KeyError, OSError, IndexError) as error:
+            self.send_json(400, {"error": "{}: {}".format(type(error).__name__, error)})
+            return
+        except Exception as error:
+            # Anything else is a bug of the service, but the client still gets a JSON answer
+            self.send_json(500, {"error": "{}: {}".format(type(error).__name__, error)})
+            return
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        image_utils.log(format % args)
+
+
+def create_server(host=HOST, port=PORT, cache_mb=CACHE_MB, hcrf_file=data_utils.HCRF_FILE):
+    data_utils.load_centroids(file=hcrf_file)
+    server = ThreadingHTTPServer((host, port), ClassificationHandler)
+    server.cache = StackCache(max_bytes=cache_mb*2**20)
+    return server
+
+
+def start_server(host=HOST, port=0, cache_mb=CACHE_MB, hcrf_file=data_utils.HCRF_FILE):
+    # Runs the service in a background thread, on a free port unless one is given; stop it with shutdown()
+    server = create_server(host=host, port=port, cache_mb=cache_mb, hcrf_file=hcrf_file)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def request_classification(source_dir, mission="sentinel2", url="http://{}:{}".format(HOST, PORT), labels=True,
+                           precision=classify_utils.DEFAULT_PRECISION, mask=None, timeout=600,
+                           backend=classify_utils.DEFAULT_BACKEND):
+    body = {"source_dir": source_dir, "mission": mission, "labels": labels, "precision": precision, "mask": mask,
+            "backend": backend}
+    request = urllib.request.Request(url + "/classify", data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as f:
+            response = json.load(f)
+    except urllib.error.HTTPError as error:
+        raise ValueError(json.load(error).get("error")) from None
+
+    response["nr_pixels"] = {int(x): y for x, y in response["nr_pixels"].items()}
+    if "labels" in response:
+        response["labels"] = decode_labels(response["labels"], response["shape"])
+    return response
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the classifier as a local service.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--cache-mb", type=int, default=CACHE_MB, help="memory cap of the band stack cache")
+    parser.add_argument("--training-data", default=data_utils.HCRF_FILE, help="path to TrainingData.csv")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    server = create_server(host=args.host, port=args.port, cache_mb=args.cache_mb, hcrf_file=args.training_data)
+    image_utils.log("Serving on http://{}:{}".format(*server.server_address))
+    server.serve_forever()